@@ -0,0 +1,103 @@
+#-----------------------------------------------------------------------------------------------------------------------
+# асинхронный доступ к базе данных
+#
+# Те же функции, что и в crud_functions, но в виде корутин: каждый запрос выполняется в отдельном потоке
+# и не останавливает цикл событий для остальных чатов.
+#   - запись (и всё, что трогает global_db) - в единственном потоке базы данных db_executor, строго по очереди;
+#   - чтение - в потоках read_executor, у каждого своё читающее соединение (ConnectionPool.reader). В режиме WAL
+#     читатели не ждут писателя, поэтому проверки is_included, is_registered, file_id и каталога не стоят
+#     в очереди за регистрациями и покупками.
+# Синхронные функции crud_functions остаются без изменений.
+
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import crud_functions
+from crud_functions import Product
+
+
+read_threads = 4
+
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+read_executor = ThreadPoolExecutor(max_workers=read_threads, thread_name_prefix='db_read')
+
+
+async def run_in_db_thread(func, *args, **kwargs):
+    """
+    выполняет синхронную функцию func в потоке базы данных
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(func, *args, **kwargs))
+
+
+async def run_in_read_thread(func, *args, **kwargs):
+    """
+    выполняет функцию чтения crud_functions в одном из потоков чтения
+    Отложенные записи (durability = 'batched') сначала записываются в потоке базы данных, чтобы чтение их видело.
+    """
+    if crud_functions.pending_count:
+        await flush_writes()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(read_executor, partial(func, *args, **kwargs))
+
+
+async def initiate_db():
+    await run_in_db_thread(crud_functions.initiate_db)
+
+
+async def close_db():
+    await run_in_db_thread(crud_functions.close_db)
+
+
+async def get_all_products() -> list[Product]:
+    return await run_in_read_thread(crud_functions.get_all_products)
+
+
+async def get_products_if_changed(version: int | None) -> tuple[int, list[Product] | None]:
+    return await run_in_read_thread(crud_functions.get_products_if_changed, version)
+
+
+async def add_user(username: str, email: str, age: int):
+    await run_in_db_thread(crud_functions.add_user, username, email, age)
+
+
+async def register_user(username: str, email: str, age: int, telegram_id: int | None = None) -> bool:
+    return await run_in_db_thread(crud_functions.register_user, username, email, age, telegram_id)
+
+
+async def is_registered(telegram_id: int) -> bool:
+    return await run_in_read_thread(crud_functions.is_registered, telegram_id)
+
+
+async def buy_product(telegram_id: int, product_id: int) -> tuple[str, int | None]:
+    return await run_in_db_thread(crud_functions.buy_product, telegram_id, product_id)
+
+
+async def is_included(username: str) -> bool:
+    return await run_in_read_thread(crud_functions.is_included, username)
+
+
+async def get_media_file_id(image: str) -> str | None:
+    file_id, touched = await run_in_read_thread(crud_functions.lookup_media_file_id, image)
+    if touched:
+        return await run_in_db_thread(crud_functions.check_media_file_id, image)
+    return file_id
+
+
+async def set_media_file_id(image: str, file_id: str):
+    await run_in_db_thread(crud_functions.set_media_file_id, image, file_id)
+
+
+async def flush_writes():
+    await run_in_db_thread(crud_functions.flush_writes)
+
+
+async def flush_writes_periodically():
+    """
+    записывает очередь отложенных записей (durability = 'batched') не позже, чем через write_flush_interval секунд
+    """
+    while True:
+        await asyncio.sleep(crud_functions.write_flush_interval)
+        if crud_functions.flush_writes_due():
+            await flush_writes()
@@ -0,0 +1,1362 @@
+"""
+бенчмарки бота без обращения к Telegram
+
+Запуск:
+    python benchmarks.py catalog [--latency 0.005]
+    python benchmarks.py registration [--users 200] [--mode async|sync]
+    python benchmarks.py writes [--rows 100000] [--inserts 2000]
+    python benchmarks.py lookup [--sizes 10000 1000000 10000000]
+    python benchmarks.py fsm [--chats 100000]
+    python benchmarks.py workers [--workers 1 2 4] [--updates 20000]
+    python benchmarks.py metrics [--updates 20000]
+    python benchmarks.py e2e [--conversations 1000] [--rate 0] [--concurrency 100] [--output results.json]
+    python benchmarks.py compare old.json new.json
+    python benchmarks.py limits [--bulk 20] [--interactive 20] [--spam 10]
+    python benchmarks.py calories [--rows 1000000] [--chunk-size 100000]
+    python benchmarks.py roundtrip [--rows 10000000] [--formats csv jsonl parquet]
+    python benchmarks.py images [--photos 20] [--sends 10000]
+    python benchmarks.py startup [--runs 5] [--target 1.0]
+    python benchmarks.py purchases [--processes 1 2 4] [--purchases 20000] [--users 100]
+    python benchmarks.py routing [--handlers 10 100 500] [--updates 5000]
+    python benchmarks.py soak [--flows 2000000] [--ttl 5] [--max-bytes 4000000] [--expire-interval 1] [--storage sqlite|memory]
+"""
+import io
+import os
+import sys
+import time
+import types
+import shutil
+import asyncio
+import subprocess
+import argparse
+import tempfile
+from collections import Counter
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiogram.types.message import Message
+
+from aiogram.utils.exceptions import RetryAfter
+
+from fake_telegram import FakeBotAPI, TooManyRequests, fake_message, letters
+
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+fake_token = '123456789:AAHfiqksKZ8WmR2zSjiQ7_v4TMAKdiHm9T0'
+
+
+def import_bot():
+    """
+    импортирует module_14_5 с фиктивным токеном, если нет credentials.py
+    :return: модуль бота
+    """
+    try:
+        import credentials
+    except ImportError:
+        credentials = types.ModuleType('credentials')
+        credentials.token = fake_token
+        sys.modules['credentials'] = credentials
+    import module_14_5
+    return module_14_5
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# mocked bot
+
+class MockBot(Bot):
+    """
+    Bot, который не ходит в сеть: каждый запрос к Bot API ждёт latency секунд и возвращает ответ FakeBotAPI
+    """
+    def __init__(self, latency: float = 0.005, api: FakeBotAPI = None):
+        super().__init__(token=fake_token)
+        self.latency = latency
+        self.api = api or FakeBotAPI()
+        self.calls = self.api.calls
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        try:
+            return self.api.result(method, data or {})
+        except TooManyRequests as e:
+            raise RetryAfter(e.retry_after)
+
+
+def percentiles(values: list[float], points=(50, 95, 99)) -> dict[str, float]:
+    """
+    :return: {'p50': ..., 'p95': ..., 'p99': ...}
+    """
+    values = sorted(values)
+    return {f'p{point}': values[min(len(values) - 1, len(values) * point // 100)] for point in points}
+
+
+async def process_update(bot_module, update: Update):
+    """
+    обрабатывает обновление так же, как при long polling и webhook: через updates_handler, в отдельной задаче
+    """
+    # StateFilter запоминает состояние FSM в contextvars - без отдельной задачи следующее обновление того же
+    # цикла увидело бы состояние, прочитанное для предыдущего
+    await asyncio.create_task(bot_module.dp.updates_handler.notify(update))
+
+
+def use_mock_bot(bot_module, bot: MockBot):
+    """
+    направляет все запросы диспетчера бота в bot
+    """
+    bot_module.dp.bot = bot
+    Bot.set_current(bot)
+    Dispatcher.set_current(bot_module.dp)
+
+
+def use_temp_db(directory: str, bot_module=None):
+    """
+    переключает базу данных (и хранилище FSM бота, если он передан) на файлы в directory
+    """
+    import crud_functions
+    from sqlite_storage import SQLiteStorage
+
+    if bot_module is not None:
+        bot_module.dp.storage = SQLiteStorage(os.path.join(directory, 'fsm.db'))
+    crud_functions.database_filename = os.path.join(directory, 'database.db')
+    crud_functions.initiate_db()
+    crud_functions.clear_db()
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# catalog
+
+def prepare_catalog_db(directory: str, count: int, bot_module=None):
+    """
+    создаёт в directory базу данных с count продуктами, у каждого своя картинка
+    """
+    import crud_functions
+
+    os.chdir(directory)
+    use_temp_db(directory, bot_module)
+    for i in range(1, count + 1):
+        shutil.copyfile(os.path.join(repo_dir, f'img{i % 4 + 1}.jpg'), f'img{i}.jpg')
+    crud_functions.fill_products_table(count)
+
+
+async def time_buying_list(bot_module, bot: MockBot) -> float:
+    message = Message(**fake_message(1, text='Купить'))
+    start = time.perf_counter()
+    await bot_module.get_buying_list(message)
+    return time.perf_counter() - start
+
+
+def bench_catalog(args):
+    import crud_functions
+    bot_module = import_bot()
+    cwd = os.getcwd()
+
+    print(f'{"products":>8} {"mode":>6} {"cold, s":>9} {"warm, s":>9}  requests (warm)')
+    for count in args.sizes:
+        for mode in ('photos', 'album'):
+            with tempfile.TemporaryDirectory() as directory:
+                prepare_catalog_db(directory, count)
+                bot_module.catalog_mode = mode
+                bot = MockBot(args.latency)
+                Bot.set_current(bot)
+                try:
+                    cold = asyncio.run(time_buying_list(bot_module, bot))
+                    bot.calls.clear()
+                    warm = asyncio.run(time_buying_list(bot_module, bot))
+                finally:
+                    crud_functions.close_db()
+                    os.chdir(cwd)
+            print(f'{count:>8} {mode:>6} {cold:>9.3f} {warm:>9.3f}  {dict(bot.calls)}')
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# registration
+
+async def register(bot_module, chat_id: int, latencies: list[float]):
+    """ один пользователь проходит всю цепочку RegistrationState """
+    for text in ('Регистрация', f'user{letters(chat_id)}', f'user{chat_id}@example.com', '30'):
+        update = Update(update_id=chat_id, message=fake_message(chat_id, text=text))
+        start = time.perf_counter()
+        await process_update(bot_module, update)
+        latencies.append(time.perf_counter() - start)
+
+
+async def measure_loop_lag(lags: list[float], interval: float = 0.001):
+    """ насколько позже положенного просыпается цикл событий """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run_registrations(bot_module, users: int) -> tuple[list[float], list[float]]:
+    latencies, lags = [], []
+    ticker = asyncio.create_task(measure_loop_lag(lags))
+    await asyncio.gather(*[register(bot_module, chat_id, latencies) for chat_id in range(1, users + 1)])
+    ticker.cancel()
+    return latencies, lags
+
+
+def bench_registration(args):
+    import crud_functions
+    bot_module = import_bot()
+
+    if args.mode == 'sync':
+        # прежнее поведение: запросы к базе данных прямо в обработчиках
+        async def is_included(username): return crud_functions.is_included(username)
+        async def register_user(username, email, age): return crud_functions.register_user(username, email, age)
+        bot_module.is_included, bot_module.register_user = is_included, register_user
+
+    with tempfile.TemporaryDirectory() as directory:
+        use_temp_db(directory, bot_module)
+        use_mock_bot(bot_module, MockBot(args.latency))
+        try:
+            start = time.perf_counter()
+            latencies, lags = asyncio.run(run_registrations(bot_module, args.users))
+            total = time.perf_counter() - start
+        finally:
+            asyncio.run(bot_module.dp.storage.close())
+            asyncio.run(bot_module.dp.storage.wait_closed())
+            crud_functions.close_db()
+
+    handler = ' '.join(f'{k}={v * 1000:.1f}ms' for k, v in percentiles(latencies).items())
+    lag = ' '.join(f'{k}={v * 1000:.1f}ms' for k, v in percentiles(lags).items())
+    print(f'mode={args.mode} users={args.users} total={total:.2f}s')
+    print(f'handler latency: {handler}')
+    print(f'event loop lag:  {lag}')
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# writes
+
+def bench_writes(args):
+    import crud_functions
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        use_temp_db(directory)
+        try:
+            start = time.perf_counter()
+            # каждый десятый возраст дробный: бот записывает возраст как float(message.text)
+            crud_functions.seed_users((f'user{i}', f'user{i}@example.com', 20 + i % 50 + (0.5 if i % 10 == 0 else 0))
+                                      for i in range(args.rows))
+            crud_functions.seed_products((f'Продукт{i}', f'описание {i}', i, f'img{i}.jpg') for i in range(args.rows))
+            seconds = time.perf_counter() - start
+            print(f'seed: {args.rows} users + {args.rows} products in {seconds:.2f}s')
+
+            for durability in ('commit', 'batched'):
+                crud_functions.durability = durability
+                start = time.perf_counter()
+                for i in range(args.inserts):
+                    crud_functions.add_user(f'{durability}{i}', f'{durability}{i}@example.com', 30)
+                crud_functions.flush_writes()
+                seconds = time.perf_counter() - start
+                print(f'add_user x {args.inserts}, durability={durability}: {seconds:.2f}s'
+                      f' ({args.inserts / seconds:.0f} rows/s)')
+        finally:
+            crud_functions.durability = 'commit'
+            crud_functions.close_db()
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# lookup
+
+def time_lookups(lookup, names: list[str]) -> float:
+    """ :return: среднее время одного поиска, с """
+    start = time.perf_counter()
+    for name in names:
+        lookup(name)
+    return (time.perf_counter() - start) / len(names)
+
+
+def bench_lookup(args):
+    import random
+    import crud_functions
+
+    def scan(username):
+        # прежний is_included: полный просмотр таблицы и fetchall
+        records = crud_functions.fetch_records_from_db(crud_functions.global_db, crud_functions.users_table,
+                                                       'username == ?', (username,))
+        return len(records) != 0
+
+    print(f'{"users":>10} {"is_included, us":>16} {"scan, us":>12}')
+    for count in args.sizes:
+        with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+            use_temp_db(directory)
+            try:
+                crud_functions.seed_users((f'user{i}', f'user{i}@example.com', 20 + i % 50) for i in range(count))
+                names = [f'user{random.randrange(count * 2)}' for _ in range(args.lookups)]
+                indexed = time_lookups(crud_functions.is_included, names)
+
+                crud_functions.global_db.execute(f'DROP INDEX {crud_functions.users_table}_username')
+                scanned = time_lookups(scan, names[:max(1, args.lookups * 10_000 // count)])
+            finally:
+                crud_functions.close_db()
+        print(f'{count:>10} {indexed * 1e6:>16.1f} {scanned * 1e6:>12.1f}')
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# fsm
+
+async def fill_storage(storage, chats: int) -> float:
+    """
+    каждый чат проходит три шага разговора
+    :return: операций хранилища в секунду
+    """
+    start = time.perf_counter()
+    for chat in range(chats):
+        await storage.set_state(chat=chat, user=chat, state='UserState:age')
+        await storage.update_data(chat=chat, user=chat, age=30.0)
+        await storage.get_state(chat=chat, user=chat)
+        await storage.set_state(chat=chat, user=chat, state='UserState:growth')
+        await storage.update_data(chat=chat, user=chat, growth=180.0)
+        await storage.get_data(chat=chat, user=chat)
+    return chats * 6 / (time.perf_counter() - start)
+
+
+def bench_fsm(args):
+    import tracemalloc
+    from aiogram.contrib.fsm_storage.memory import MemoryStorage
+    from sqlite_storage import SQLiteStorage
+
+    print(f'{"storage":>14} {"ops/s":>10} {"memory, MB":>11}')
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        storages = {
+            'MemoryStorage': lambda: MemoryStorage(),
+            'SQLiteStorage': lambda: SQLiteStorage(os.path.join(directory, 'fsm.db'), cache_size=args.cache_size),
+        }
+        for name, make_storage in storages.items():
+            async def run():
+                storage = make_storage()
+                tracemalloc.start()
+                ops = await fill_storage(storage, args.chats)
+                if isinstance(storage, SQLiteStorage):
+                    await storage.flush()
+                memory = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                await storage.close()
+                await storage.wait_closed()
+                return ops, memory
+
+            ops, memory = asyncio.run(run())
+            print(f'{name:>14} {ops:>10.0f} {memory / 2**20:>11.1f}')
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# workers
+
+def start_fake_telegram(port: int, latency: float, limits: bool = False) -> subprocess.Popen:
+    """
+    запускает fake_telegram.py serve в отдельном процессе и ждёт, пока он начнёт принимать запросы
+    :param limits:  отвечать 429 при превышении лимитов Telegram на отправку сообщений
+    """
+    import socket
+
+    limit_args = ['--chat-rate', '1', '--global-rate', '30'] if limits else []
+    server = subprocess.Popen([sys.executable, os.path.join(repo_dir, 'fake_telegram.py'), 'serve',
+                               '--port', str(port), '--latency', str(latency), *limit_args],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('fake_telegram.py did not start')
+
+
+def bench_workers(args):
+    from supervisor import Supervisor
+    from fake_telegram import scripted_updates
+
+    cwd = os.getcwd()
+    updates = scripted_updates(args.updates, args.chats)
+    server = start_fake_telegram(args.port, args.latency)
+    api_server = f'http://localhost:{args.port}'
+
+    print(f'{"workers":>7} {"updates/s":>10}  processed by worker')
+    try:
+        for workers in args.workers:
+            with tempfile.TemporaryDirectory() as directory:
+                # рабочие процессы запускаются заново и берут фиктивный токен из credentials.py в directory
+                with open(os.path.join(directory, 'credentials.py'), 'w') as file:
+                    file.write(f'token = {fake_token!r}\n')
+                sys.path.insert(0, directory)
+                os.chdir(directory)
+                try:
+                    supervisor = Supervisor(workers, api_server, send_limits=False)
+                    supervisor.start()
+                    start = time.perf_counter()
+                    for update in updates:
+                        supervisor.route(update)
+                    processed = supervisor.stop()
+                    seconds = time.perf_counter() - start
+                finally:
+                    sys.path.remove(directory)
+                    os.chdir(cwd)
+            print(f'{workers:>7} {len(updates) / seconds:>10.0f}  {dict(sorted(processed.items()))}')
+    finally:
+        server.kill()
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# metrics
+
+async def process_updates(bot_module, updates: list[dict]) -> float:
+    """
+    :return: обновлений в секунду при обработке по одному
+    """
+    start = time.perf_counter()
+    for update in updates:
+        await process_update(bot_module, Update(**update))
+    return len(updates) / (time.perf_counter() - start)
+
+
+def bench_metrics(args):
+    import crud_functions
+    import metrics
+    from fake_telegram import scripted_updates
+
+    bot_module = import_bot()
+    middleware = next(app for app in bot_module.dp.middleware.applications
+                      if isinstance(app, metrics.MetricsMiddleware))
+    updates = scripted_updates(args.updates, args.chats)
+
+    print(f'{"metrics":>7} {"updates/s":>10}')
+    for enabled in (False, True, False, True):
+        with tempfile.TemporaryDirectory() as directory:
+            use_temp_db(directory, bot_module)
+            bot = MockBot(latency=0)
+            if enabled:
+                metrics.instrument_bot(bot)
+                bot_module.dp.middleware.applications.append(middleware)
+                crud_functions.query_hooks.append(metrics.observe_query)
+            else:
+                bot_module.dp.middleware.applications.remove(middleware)
+                crud_functions.query_hooks.remove(metrics.observe_query)
+            use_mock_bot(bot_module, bot)
+
+            async def run():
+                rate = await process_updates(bot_module, updates)
+                await bot_module.dp.storage.close()
+                await bot_module.dp.storage.wait_closed()
+                return rate
+
+            try:
+                rate = asyncio.run(run())
+            finally:
+                crud_functions.close_db()
+        print(f'{"on" if enabled else "off":>7} {rate:>10.0f}')
+
+    if args.show:
+        print(metrics.render())
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# end-to-end: разговоры через настоящий HTTP к fake_telegram.py
+
+async def replay(bot_module, scripts: list[tuple[str, list[dict]]], rate: float, concurrency: int
+                 ) -> dict[str, list[float]]:
+    """
+    проигрывает разговоры: шаги одного разговора - по очереди, одновременно - не больше concurrency разговоров
+    :param scripts:     (вид разговора, обновления)
+    :param rate:        обновлений в секунду на все разговоры, 0 - без ограничения
+    :return:            {вид разговора: задержки обработки обновлений, с}
+    """
+    latencies: dict[str, list[float]] = {kind: [] for kind, _ in scripts}
+    semaphore = asyncio.Semaphore(concurrency)
+    start = time.perf_counter()
+    sent = 0
+
+    async def converse(kind: str, updates: list[dict]):
+        nonlocal sent
+        async with semaphore:
+            for update in updates:
+                begin = time.perf_counter()
+                if rate:
+                    # задержка считается от назначенного времени отправки, а не от фактического:
+                    # если бот не успевает, ожидание в очереди тоже попадает в задержку
+                    begin = start + sent / rate
+                    sent += 1
+                    if begin > time.perf_counter():
+                        await asyncio.sleep(begin - time.perf_counter())
+                await process_update(bot_module, Update(**update))
+                latencies[kind].append(time.perf_counter() - begin)
+
+    await asyncio.gather(*[converse(kind, updates) for kind, updates in scripts])
+    return latencies
+
+
+def summary(latencies: list[float]) -> dict[str, float]:
+    return {'updates': len(latencies), **{k: v * 1000 for k, v in percentiles(latencies).items()}}
+
+
+def max_rss() -> float | None:
+    """ :return: наибольший размер процесса в памяти, МБ, None - если не известен (Windows) """
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_e2e(args):
+    import json
+    import tracemalloc
+    import crud_functions
+    from aiohttp import ClientSession
+    from aiogram.bot.api import TelegramAPIServer
+    from fake_telegram import conversations, conversation_updates
+
+    bot_module = import_bot()
+    kinds = args.kinds or list(conversations)
+    scripts, update_id = [], 1
+    for chat_id in range(1, args.conversations + 1):
+        kind = kinds[chat_id % len(kinds)]
+        scripts.append((kind, conversation_updates(kind, chat_id, update_id)))
+        update_id += len(conversations[kind])
+
+    async def run():
+        rss = max_rss()
+        if args.tracemalloc:
+            tracemalloc.start()
+        start = time.perf_counter()
+        latencies = await replay(bot_module, scripts, args.rate, args.concurrency)
+        seconds = time.perf_counter() - start
+        memory = {'rss_peak_mb': max_rss(), 'rss_growth_mb': max_rss() - rss if rss is not None else None}
+        if args.tracemalloc:
+            memory['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+
+        await bot_module.dp.storage.close()
+        await bot_module.dp.storage.wait_closed()
+        await (await bot_module.bot.get_session()).close()
+        async with ClientSession() as session:
+            async with session.get(f'http://localhost:{args.port}/stats') as response:
+                api_calls = await response.json()
+
+        updates = sum(len(values) for values in latencies.values())
+        return {
+            'total': {**summary([value for values in latencies.values() for value in values]),
+                      'seconds': seconds, 'updates/s': updates / seconds},
+            **{kind: summary(values) for kind, values in latencies.items()},
+            'memory': memory,
+            'api_calls': api_calls,
+        }
+
+    cwd = os.getcwd()
+    if not args.telegram_limits:
+        bot_module.send_scheduler.set_limits(None, 0, None, 0)
+    server = start_fake_telegram(args.port, args.latency, args.telegram_limits)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            prepare_catalog_db(directory, args.products, bot_module)
+            bot_module.bot.server = TelegramAPIServer.from_base(f'http://localhost:{args.port}')
+            use_mock_bot(bot_module, bot_module.bot)
+            try:
+                results = asyncio.run(run())
+            finally:
+                crud_functions.close_db()
+                os.chdir(cwd)
+    finally:
+        server.kill()
+
+    params = {key: value for key, value in vars(args).items() if key not in ('func', 'output')}
+    report = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'params': params,
+              'results': results}
+    print_e2e(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+def print_e2e(results: dict):
+    total = results['total']
+    print(f'{total["updates"]} updates in {total["seconds"]:.2f}s, {total["updates/s"]:.0f} updates/s')
+    print(f'{"":>14} {"updates":>8} {"p50, ms":>8} {"p95, ms":>8} {"p99, ms":>8}')
+    for kind, values in results.items():
+        if 'p50' in values:
+            print(f'{kind:>14} {values["updates"]:>8} {values["p50"]:>8.2f} {values["p95"]:>8.2f} {values["p99"]:>8.2f}')
+    print('memory:', ' '.join(f'{k}={v:.1f}' for k, v in results['memory'].items() if v is not None))
+    print('api calls:', results['api_calls'])
+
+
+def bench_compare(args):
+    """
+    сравнивает два файла результатов e2e: задержки и пропускную способность
+    """
+    import json
+
+    with open(args.old, encoding='utf-8') as file:
+        old = json.load(file)
+    with open(args.new, encoding='utf-8') as file:
+        new = json.load(file)
+
+    print(f'old: {old["commit"]} {old["time"]}')
+    print(f'new: {new["commit"]} {new["time"]}')
+    print(f'{"":>24} {"old":>10} {"new":>10} {"change":>8}')
+    for kind, values in new['results'].items():
+        if kind == 'api_calls':
+            continue
+        for metric, value in values.items():
+            before = old['results'].get(kind, {}).get(metric)
+            if value is None or before is None or metric == 'updates':
+                continue
+            change = f'{(value - before) / before * 100:+.1f}%' if before else ''
+            print(f'{kind + " " + metric:>24} {before:>10.2f} {value:>10.2f} {change:>8}')
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# limits: лимиты Telegram на отправку сообщений
+
+async def burst(bot_module, groups: dict[str, list[Update]]) -> tuple[dict[str, list[float]], int]:
+    """
+    обрабатывает все обновления одновременно
+    :return: ({группа: задержки обработки, с}, число обновлений, упавших с ошибкой)
+    """
+    latencies = {group: [] for group in groups}
+    failed = 0
+
+    async def run(group: str, update: Update):
+        nonlocal failed
+        start = time.perf_counter()
+        try:
+            await process_update(bot_module, update)
+        except Exception:
+            failed += 1
+        latencies[group].append(time.perf_counter() - start)
+
+    await asyncio.gather(*[run(group, update) for group, updates in groups.items() for update in updates])
+    return latencies, failed
+
+
+def bench_limits(args):
+    import logging
+    import crud_functions
+    from send_scheduler import SendScheduler
+    from fake_telegram import fake_update
+
+    logging.getLogger('send_scheduler').setLevel(logging.ERROR)
+    bot_module = import_bot()
+    cwd = os.getcwd()
+
+    # одновременно: каталог в bulk чатах, нажатие "купить" в interactive чатах, по 5 сообщений подряд в spam чатах
+    chat_id = iter(range(1, 1_000_000))
+    groups = {
+        'bulk':        [fake_update(1, next(chat_id), text='Купить') for _ in range(args.bulk)],
+        'interactive': [fake_update(1, next(chat_id), callback_data='product_buying 1')
+                        for _ in range(args.interactive)],
+        'spam':        [fake_update(1, chat, text=f'сообщение {i}')
+                        for chat in [next(chat_id) for _ in range(args.spam)] for i in range(5)],
+    }
+    groups = {group: [Update(**update) for update in updates] for group, updates in groups.items()}
+
+    print(f'{"mode":>9} {"total, s":>9} {"failed":>7} {"429":>5} {"messages":>9} {"coalesced":>9}  '
+          f'p50/p99, s: ' + ' '.join(groups))
+    for mode in ('direct', 'scheduler'):
+        with tempfile.TemporaryDirectory() as directory:
+            prepare_catalog_db(directory, args.products, bot_module)
+            api = FakeBotAPI(chat_rate=args.chat_rate, global_rate=args.global_rate)
+            bot = MockBot(args.latency, api)
+            scheduler = SendScheduler(chat_rate=args.chat_rate, global_rate=args.global_rate)
+            if mode == 'scheduler':
+                scheduler.install(bot)
+            use_mock_bot(bot_module, bot)
+
+            async def run():
+                await bot_module.refresh_catalog()
+                start = time.perf_counter()
+                latencies, failed = await burst(bot_module, groups)
+                seconds = time.perf_counter() - start
+                await scheduler.close()
+                await bot_module.dp.storage.close()
+                await bot_module.dp.storage.wait_closed()
+                return seconds, latencies, failed
+
+            try:
+                seconds, latencies, failed = asyncio.run(run())
+            finally:
+                crud_functions.close_db()
+                os.chdir(cwd)
+
+        messages = sum(count for method, count in api.calls.items() if method.startswith('send'))
+        quantiles = ' '.join(f'{percentiles(values, (50,))["p50"]:.2f}/{percentiles(values, (99,))["p99"]:.2f}'
+                             for values in latencies.values())
+        print(f'{mode:>9} {seconds:>9.2f} {failed:>7} {api.calls["429"]:>5} {messages:>9} '
+              f'{scheduler.stats["coalesced"]:>9}  {quantiles}')
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# calories
+
+def bench_calories(args):
+    import csv
+    import random
+    import sqlite3
+    import tracemalloc
+    import calories
+
+    # значения, посчитанные по формуле вручную: ниже пакетный расчёт сверяется с calc_calories, а он - с ними
+    known = [('F', 30, 165, 60, 1320.25), ('M', 30, 180, 80, 1780.0)]
+    for *row, expected in known:
+        assert calories.calc_calories(*row) == expected, (row, calories.calc_calories(*row), expected)
+    columns = list(zip(*[row[:4] for row in known]))
+    assert list(calories.calc_calories_batch(*columns)) == [row[4] for row in known]
+
+    random.seed(1)
+    gender = [random.choice('MF') for _ in range(args.rows)]
+    age = [random.uniform(18, 90) for _ in range(args.rows)]
+    growth = [float(random.randint(140, 210)) for _ in range(args.rows)]
+    weight = [round(random.uniform(40, 150), 1) for _ in range(args.rows)]
+    print(f'rows={args.rows} numpy={"yes" if calories.numpy() is not None else "no"}')
+
+    start = time.perf_counter()
+    loop = [calories.calc_calories(*row) for row in zip(gender, age, growth, weight)]
+    loop_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = calories.calc_calories_batch(gender, age, growth, weight)
+    batch_seconds = time.perf_counter() - start
+    batch = batch if isinstance(batch, list) else batch.tolist()
+
+    print(f'python loop:          {loop_seconds:.3f}s ({args.rows / loop_seconds:.0f} rows/s)')
+    print(f'batch from lists:     {batch_seconds:.3f}s ({args.rows / batch_seconds:.0f} rows/s), '
+          f'identical to loop: {batch == loop}')
+    np = calories.numpy()
+    if np is not None:
+        columns = [np.asarray(gender)] + [np.asarray(column) for column in (age, growth, weight)]
+        start = time.perf_counter()
+        batch = calories.calc_calories_batch(*columns)
+        seconds = time.perf_counter() - start
+        print(f'batch from arrays:    {seconds:.3f}s ({args.rows / seconds:.0f} rows/s), '
+              f'identical to loop: {batch.tolist() == loop}')
+        del columns
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        csv_name = os.path.join(directory, 'cohort.csv')
+        with open(csv_name, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(('gender', 'age', 'growth', 'weight'))
+            writer.writerows(zip(gender, map(repr, age), map(repr, growth), map(repr, weight)))
+
+        db = sqlite3.connect(os.path.join(directory, 'cohort.db'))
+        db.execute('CREATE TABLE Cohort (gender TEXT, age REAL, growth REAL, weight REAL)')
+        with db:
+            db.executemany('INSERT INTO Cohort VALUES (?, ?, ?, ?)', zip(gender, age, growth, weight))
+        del gender, age, growth, weight
+
+        with open(csv_name, newline='', encoding='utf-8') as file:
+            sources = {
+                'csv stream': lambda: calories.csv_chunks(file, args.chunk_size),
+                'sqlite stream': lambda: calories.sqlite_chunks(db, 'SELECT gender, age, growth, weight FROM Cohort',
+                                                               chunk_size=args.chunk_size),
+            }
+            for name, chunks in sources.items():
+                for traced in (False, True):
+                    file.seek(0)
+                    if traced:
+                        tracemalloc.start()
+                    start = time.perf_counter()
+                    identical, offset = True, 0
+                    for result in calories.calories_stream(chunks()):
+                        result = result if isinstance(result, list) else result.tolist()
+                        identical = identical and result == loop[offset:offset + len(result)]
+                        offset += len(result)
+                    if traced:
+                        # память - во втором проходе: tracemalloc сильно замедляет расчёт
+                        peak = tracemalloc.get_traced_memory()[1]
+                        tracemalloc.stop()
+                    else:
+                        seconds = time.perf_counter() - start
+                print(f'{name + ":":<22}{seconds:.3f}s ({args.rows / seconds:.0f} rows/s), '
+                      f'peak memory {peak / 2**20:.1f} MB, identical to loop: {identical and offset == len(loop)}')
+        db.close()
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# roundtrip
+
+def tables_equal(first: str, second: str, table: str) -> bool:
+    import sqlite3
+
+    db = sqlite3.connect(first)
+    try:
+        db.execute('ATTACH DATABASE ? AS other', (second,))
+        counts = db.execute(f'SELECT (SELECT COUNT(*) FROM {table}), (SELECT COUNT(*) FROM other.{table})').fetchone()
+        differ = db.execute(f'SELECT COUNT(*) FROM (SELECT * FROM {table} EXCEPT SELECT * FROM other.{table})'
+                            ).fetchone()[0]
+    finally:
+        db.close()
+    return counts[0] == counts[1] and differ == 0
+
+
+def bench_roundtrip(args):
+    import crud_functions
+    import table_io
+
+    tables = (crud_functions.users_table, crud_functions.products_table)
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        source = os.path.join(directory, 'source')
+        os.mkdir(source)
+        use_temp_db(source)
+        try:
+            start = time.perf_counter()
+            # каждый десятый возраст дробный: бот записывает возраст как float(message.text)
+            crud_functions.seed_users((f'user{i}', f'user{i}@example.com', 20 + i % 50 + (0.5 if i % 10 == 0 else 0))
+                                      for i in range(args.rows))
+            crud_functions.seed_products((f'Продукт{i}', f'описание {i}', i, f'img{i}.jpg') for i in range(args.rows))
+            print(f'seed: {args.rows} users + {args.rows} products in {time.perf_counter() - start:.2f}s, '
+                  f'peak RSS {max_rss():.0f} MB')
+
+            for extension in args.formats:
+                for table in tables:
+                    filename = os.path.join(directory, f'{table}.{extension}')
+                    start = time.perf_counter()
+                    count = table_io.export_table(table, filename)
+                    seconds = time.perf_counter() - start
+                    print(f'export {table:<8} {extension:<7} {seconds:7.2f}s ({count / seconds:>9.0f} rows/s), '
+                          f'{os.path.getsize(filename) / 2**20:7.1f} MB file, peak RSS {max_rss():.0f} MB')
+        finally:
+            crud_functions.close_db()
+
+        for extension in args.formats:
+            target = os.path.join(directory, extension)
+            os.mkdir(target)
+            use_temp_db(target)
+            try:
+                for table in tables:
+                    start = time.perf_counter()
+                    count = table_io.import_table(table, os.path.join(directory, f'{table}.{extension}'))
+                    seconds = time.perf_counter() - start
+                    print(f'import {table:<8} {extension:<7} {seconds:7.2f}s ({count / seconds:>9.0f} rows/s), '
+                          f'peak RSS {max_rss():.0f} MB')
+            finally:
+                crud_functions.close_db()
+            for table in tables:
+                equal = tables_equal(os.path.join(source, 'database.db'), os.path.join(target, 'database.db'), table)
+                print(f'roundtrip {table:<8} {extension:<7} identical: {equal}')
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# images
+
+def make_camera_photos(directory: str, count: int) -> list[str]:
+    """
+    :return: имена count картинок размером с фотографию с телефона, с EXIF, комментарием и поворотом
+    """
+    import random
+    from PIL import Image, ImageDraw
+
+    random.seed(1)
+    names = []
+    for i in range(count):
+        image = Image.new('RGB', (4032, 3024), tuple(random.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(200):
+            x, y = random.randrange(4032), random.randrange(3024)
+            draw.ellipse((x, y, x + random.randrange(50, 800), y + random.randrange(50, 800)),
+                         fill=tuple(random.randrange(256) for _ in range(3)))
+        exif = Image.Exif()
+        exif[0x010f] = 'Camera'
+        exif[0x0112] = 6                # повёрнута на 90°
+        name = os.path.join(directory, f'photo{i}.jpg')
+        image.save(name, quality=92, exif=exif, comment=b'GPS 55.75 37.62')
+        names.append(name)
+    return names
+
+
+def bench_images(args):
+    import images
+    from aiogram.types import InputFile
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        os.chdir(directory)
+        sources = [os.path.join(repo_dir, f'img{i}.jpg') for i in range(1, 5)]
+        if images.pillow() is not None:
+            sources += make_camera_photos(directory, args.photos)
+        else:
+            print('Pillow is not installed: images are copied as is')
+
+        start = time.perf_counter()
+        prepared = [images.prepare_image(name) for name in sources]
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        for name in sources:
+            images.prepare_image(name)
+        warm = time.perf_counter() - start
+        before = sum(os.path.getsize(name) for name in sources)
+        after = sum(os.path.getsize(name) for name in prepared)
+        print(f'prepare {len(sources)} images: {cold:.2f}s, again (already prepared): {warm:.3f}s')
+        print(f'upload size: {before / 2**20:.2f} MB -> {after / 2**20:.2f} MB ({after / before:.1%})')
+        if images.pillow() is not None:
+            names = [name for name in prepared if os.path.dirname(name) == images.media_dir]
+            names += [images.thumbnail_name(name) for name in names]
+            left = [name for name in names if images.has_metadata(images.load(name))]
+            print(f'metadata left in {len(left)} of {len(names)} prepared images and thumbnails')
+
+        def read_file(name):
+            # прежняя отправка: InputFile открывает файл, aiohttp читает его при каждом запросе
+            file = InputFile(name)
+            with file.file:
+                return len(file.file.read())
+
+        def read_preloaded(name):
+            file = InputFile(io.BytesIO(images.load(name)), filename=os.path.basename(name))
+            return len(file.file.read())
+
+        for title, send in (('open() per send', read_file), ('preloaded', read_preloaded)):
+            start = time.perf_counter()
+            for i in range(args.sends):
+                send(prepared[i % len(prepared)])
+            seconds = time.perf_counter() - start
+            print(f'{title + ":":<18}{seconds / args.sends * 1e6:8.1f} us per photo')
+        os.chdir(repo_dir)
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# startup
+
+# процесс бота для bench_startup: печатает метку после каждого этапа запуска, время меток отмечает родитель
+startup_script = f'''
+import sys, types
+try:
+    import credentials
+except ImportError:
+    sys.modules['credentials'] = types.ModuleType('credentials')
+    sys.modules['credentials'].token = {fake_token!r}
+import module_14_5
+print('imported', flush=True)
+
+import asyncio
+import crud_functions
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from fake_telegram import FakeBotAPI, fake_update
+
+crud_functions.database_filename = sys.argv[1]
+crud_functions.initiate_db()
+print('database', flush=True)
+
+api = FakeBotAPI()
+async def request(method, data=None, files=None, **kwargs):
+    return api.result(method, data or {{}})
+module_14_5.bot.request = request
+Bot.set_current(module_14_5.bot)
+Dispatcher.set_current(module_14_5.dp)
+
+async def first_updates():
+    for label, text in (('first_update', '/start'), ('catalog', 'Купить')):
+        update = Update(**fake_update(1, 1, text=text))
+        await asyncio.create_task(module_14_5.dp.updates_handler.notify(update))
+        print(label, flush=True)
+asyncio.run(first_updates())
+crud_functions.close_db()
+'''
+
+
+def time_startup(directory: str, database: str) -> dict[str, float]:
+    """
+    :return: {метка: секунд от запуска процесса}
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [repo_dir, os.environ.get('PYTHONPATH')])))
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', startup_script, database], cwd=directory, env=env,
+                               stdout=subprocess.PIPE, text=True)
+    marks = {}
+    for line in process.stdout:
+        marks[line.strip()] = time.perf_counter() - start
+    if process.wait():
+        raise RuntimeError(f'bot process exited with {process.returncode}')
+    return marks
+
+
+def import_times(directory: str) -> list[tuple[str, int, int]]:
+    """
+    :return: [(модуль, собственное время импорта, время вместе с вложенными импортами)], мкс, по python -X importtime
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [repo_dir, os.environ.get('PYTHONPATH')])))
+    script = startup_script[:startup_script.index("print('imported'")]
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], cwd=directory, env=env,
+                            capture_output=True, text=True, check=True).stderr
+    times = []
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '[us]' not in line:
+            own, cumulative, name = line[len('import time:'):].split('|')
+            times.append((name.strip(), int(own), int(cumulative)))
+    return times
+
+
+def bench_startup(args):
+    marks = ('imported', 'database', 'first_update', 'catalog')
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        times = import_times(directory)
+        total = next(cumulative for name, own, cumulative in times if name == 'module_14_5')
+        print(f'import module_14_5: {total / 1000:.0f} ms, slowest modules (own time):')
+        for name, own, cumulative in sorted(times, key=lambda item: -item[1])[:args.top]:
+            print(f'    {own / 1000:7.1f} ms  {name}')
+
+        results = {'new database': [], 'current schema': []}
+        current = os.path.join(directory, 'current.db')
+        for run in range(args.runs):
+            results['new database'].append(time_startup(directory, os.path.join(directory, f'new{run}.db')))
+            results['current schema'].append(time_startup(directory, current))
+
+        print(f'{"database":<16}' + ''.join(f'{mark + ", s":>16}' for mark in marks) + '  (median from process start)')
+        for name, runs in results.items():
+            medians = {mark: sorted(run[mark] for run in runs)[len(runs) // 2] for mark in marks}
+            print(f'{name:<16}' + ''.join(f'{medians[mark]:>16.3f}' for mark in marks))
+        first = sorted(run['first_update'] for run in results['current schema'])[args.runs // 2]
+        print(f'time to first update {first:.3f}s, target {args.target:.3f}s: {"met" if first <= args.target else "MISSED"}')
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# purchases
+
+def buyer_main(database: str, users: int, products: int, purchases: int, seed: int, start, results):
+    """
+    процесс покупателей: purchases покупок случайных продуктов случайными пользователями, без пауз
+    """
+    import random
+    import crud_functions
+
+    random.seed(seed)
+    crud_functions.database_filename = database
+    crud_functions.initiate_db()
+    counts = Counter()
+    try:
+        start.wait()
+        began = time.perf_counter()
+        for _ in range(purchases):
+            result, _ = crud_functions.buy_product(random.randint(1, users), random.randint(1, products))
+            counts[result] += 1
+        results.put((time.perf_counter() - began, dict(counts)))
+    finally:
+        crud_functions.close_db()
+
+
+def check_ledger(database: str, users: int) -> tuple[bool, int]:
+    """
+    :return: (балансы и журнал покупок согласованы, число записей журнала)
+    """
+    import sqlite3
+    import crud_functions
+
+    db = sqlite3.connect(database)
+    try:
+        balances, negative = db.execute(f'SELECT SUM(balance), SUM(balance < 0) FROM {crud_functions.users_table}'
+                                        ).fetchone()
+        spent, ledger = db.execute(f'SELECT COALESCE(SUM(price), 0), COUNT(*) FROM {crud_functions.purchases_table}'
+                                   ).fetchone()
+    finally:
+        db.close()
+    return balances + spent == users * 1000 and negative == 0, ledger
+
+
+def bench_purchases(args):
+    import multiprocessing
+    import crud_functions
+
+    context = multiprocessing.get_context('spawn')
+    print(f'{"processes":>9} {"purchases/s":>12} {"done":>8} {"no_money":>9} {"p/s per proc":>13}  ledger consistent')
+    for processes in args.processes:
+        with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+            use_temp_db(directory)
+            try:
+                crud_functions.seed_users((f'user{i}', f'user{i}@example.com', 30) for i in range(args.users))
+                crud_functions.seed_products((f'Продукт{i}', f'описание {i}', i, None)
+                                             for i in range(1, args.products + 1))
+                with crud_functions.global_db:
+                    crud_functions.global_db.execute(f'UPDATE {crud_functions.users_table} SET telegram_id = id')
+            finally:
+                crud_functions.close_db()
+
+            start, results = context.Event(), context.Queue()
+            per_process = args.purchases // processes
+            workers = [context.Process(target=buyer_main, args=(crud_functions.database_filename, args.users,
+                                                                args.products, per_process, seed, start, results))
+                       for seed in range(processes)]
+            for worker in workers:
+                worker.start()
+            time.sleep(1.0)         # процессы успевают запуститься и открыть базу данных
+            start.set()
+            outcomes = [results.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+
+            seconds = max(seconds for seconds, _ in outcomes)
+            counts = sum((Counter(counts) for _, counts in outcomes), Counter())
+            consistent, ledger = check_ledger(crud_functions.database_filename, args.users)
+            consistent = consistent and ledger == counts[crud_functions.purchase_done]
+            total = per_process * processes
+            print(f'{processes:>9} {total / seconds:>12.0f} {counts[crud_functions.purchase_done]:>8} '
+                  f'{counts[crud_functions.purchase_no_money]:>9} {total / seconds / processes:>13.0f}  {consistent}')
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# routing
+
+def routing_dispatcher(count: int, routed: bool) -> tuple[Dispatcher, list[str]]:
+    """
+    диспетчер с count обработчиками текста, count обработчиками кнопок, count / 10 обработчиками состояний
+    и обработчиком остальных сообщений
+    :return: диспетчер и список, в который обработчики записывают свои имена
+    """
+    import routing
+    from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+    dp = Dispatcher(MockBot(), storage=MemoryStorage())
+    if routed:
+        routing.install(dp)
+    calls = []
+
+    def handler(name: str):
+        async def handle(obj):
+            calls.append(name)
+        return handle
+
+    for i in range(count):
+        dp.register_message_handler(handler(f'text{i}'), text=f'команда {i}')
+    for i in range(count // 10):
+        dp.register_message_handler(handler(f'state{i}'), state=f'State:{i}')
+    for i in range(count):
+        dp.register_callback_query_handler(handler(f'button{i}'), text_startswith=f'button{i} ')
+    dp.register_message_handler(handler('all_messages'))
+    return dp, calls
+
+
+async def dispatch(dp: Dispatcher, count: int, updates: int, chats: int) -> float:
+    """
+    :return: среднее время обработки одного обновления, с
+    """
+    from fake_telegram import fake_update
+
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    for chat_id in range(1, chats + 1, 10):
+        await dp.storage.set_state(chat=chat_id, user=chat_id, state=f'State:{chat_id % max(1, count // 10)}')
+    steps = [{'text': f'команда {count - 1}'}, {'text': 'привет'}, {'callback_data': f'button{count - 1} 5'},
+             {'text': f'команда {count // 2}'}]
+    batch = [Update(**fake_update(i, i % chats + 1, **steps[i % len(steps)])) for i in range(updates)]
+
+    start = time.perf_counter()
+    for update in batch:
+        await asyncio.create_task(dp.updates_handler.notify(update))
+    return (time.perf_counter() - start) / updates
+
+
+def bench_routing(args):
+    print(f'{"handlers":>8} {"linear, us":>11} {"routed, us":>11}  same handlers')
+    for count in args.handlers:
+        seconds, calls = {}, {}
+        for routed in (False, True):
+            dp, calls[routed] = routing_dispatcher(count, routed)
+            seconds[routed] = asyncio.run(dispatch(dp, count, args.updates, args.chats))
+        print(f'{count:>8} {seconds[False] * 1e6:>11.1f} {seconds[True] * 1e6:>11.1f}  '
+              f'{calls[False] == calls[True]}')
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# soak
+
+def current_rss() -> float | None:
+    """ :return: текущий размер процесса в памяти, МБ, None - если не известен (не Linux) """
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+async def abandoned_flows(storage, flows: int, report: int, filename: str | None):
+    """
+    каждый чат начинает регистрацию, вводит имя и почту и больше не пишет
+    :param report:  через сколько разговоров печатать строку
+    """
+    from metrics import fsm_usage
+
+    start = time.perf_counter()
+    for chat in range(1, flows + 1):
+        await storage.set_state(chat=chat, user=chat, state='RegistrationState:username')
+        await storage.update_data(chat=chat, user=chat, username=f'user{chat}')
+        await storage.set_state(chat=chat, user=chat, state='RegistrationState:email')
+        await storage.update_data(chat=chat, user=chat, email=f'user{chat}@example.com')
+        await storage.set_state(chat=chat, user=chat, state='RegistrationState:age')
+        if chat % report == 0:
+            usage = await fsm_usage(storage)
+            size = sum(os.path.getsize(name) for name in (filename, f'{filename}-wal')
+                       if filename and os.path.exists(name))
+            print(f'{chat:>10} {time.perf_counter() - start:>8.1f} {current_rss() or 0:>8.1f} '
+                  f'{usage["conversations"]:>8} {usage["bytes"] / 2**20:>8.2f} {usage["cached_conversations"]:>7} '
+                  f'{usage["cached_bytes"] / 2**20:>8.2f} {size / 2**20:>8.1f}', flush=True)
+
+
+def bench_soak(args):
+    from aiogram.contrib.fsm_storage.memory import MemoryStorage
+    from sqlite_storage import SQLiteStorage
+
+    print(f'{"flows":>10} {"time, s":>8} {"RSS, MB":>8} {"live":>8} {"live, MB":>8} {"cached":>7} '
+          f'{"cache, MB":>8} {"file, MB":>8}')
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        filename = os.path.join(directory, 'fsm.db')
+
+        async def run():
+            if args.storage == 'memory':
+                storage = MemoryStorage()
+            else:
+                storage = SQLiteStorage(filename, cache_size=args.cache_size, ttl=args.ttl,
+                                        memory_budget=args.memory_budget, max_bytes=args.max_bytes,
+                                        expire_interval=args.expire_interval,
+                                        stats_interval=0)     # каждая строка отчёта - по текущим данным
+            await abandoned_flows(storage, args.flows, args.report, filename if args.storage == 'sqlite' else None)
+            await storage.close()
+            await storage.wait_closed()
+
+        asyncio.run(run())
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    catalog = commands.add_parser('catalog', help='вывод каталога по кнопке "Купить"')
+    catalog.add_argument('--latency', type=float, default=0.005, help='задержка одного запроса к Bot API, с')
+    catalog.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='размеры каталога')
+    catalog.set_defaults(func=bench_catalog)
+
+    registration = commands.add_parser('registration', help='одновременная регистрация пользователей')
+    registration.add_argument('--latency', type=float, default=0.005, help='задержка одного запроса к Bot API, с')
+    registration.add_argument('--users', type=int, default=200, help='число одновременных регистраций')
+    registration.add_argument('--mode', choices=['async', 'sync'], default='async',
+                              help='async - база данных в отдельном потоке, sync - прямо в обработчиках')
+    registration.set_defaults(func=bench_registration)
+
+    writes = commands.add_parser('writes', help='массовое заполнение и пакетная запись')
+    writes.add_argument('--rows', type=int, default=100_000, help='число пользователей и продуктов для seed_*')
+    writes.add_argument('--inserts', type=int, default=2000, help='число вызовов add_user')
+    writes.add_argument('--dir', default=None, help='каталог для базы данных (по умолчанию - временный)')
+    writes.set_defaults(func=bench_writes)
+
+    lookup = commands.add_parser('lookup', help='поиск пользователя по имени (is_included)')
+    lookup.add_argument('--sizes', type=int, nargs='+', default=[10_000, 1_000_000, 10_000_000],
+                        help='число пользователей в таблице')
+    lookup.add_argument('--lookups', type=int, default=10_000, help='число поисков (половина - отсутствующие имена)')
+    lookup.add_argument('--dir', default=None, help='каталог для базы данных (по умолчанию - временный)')
+    lookup.set_defaults(func=bench_lookup)
+
+    fsm = commands.add_parser('fsm', help='хранилища состояний FSM')
+    fsm.add_argument('--chats', type=int, default=100_000, help='число одновременных разговоров')
+    fsm.add_argument('--cache-size', type=int, default=10_000, help='размер кэша SQLiteStorage')
+    fsm.add_argument('--dir', default=None, help='каталог для базы данных (по умолчанию - временный)')
+    fsm.set_defaults(func=bench_fsm)
+
+    workers = commands.add_parser('workers', help='пропускная способность supervisor.py от числа процессов')
+    workers.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='число рабочих процессов')
+    workers.add_argument('--updates', type=int, default=20_000, help='число обновлений')
+    workers.add_argument('--chats', type=int, default=1000, help='число чатов')
+    workers.add_argument('--latency', type=float, default=0.005, help='задержка ответа fake_telegram.py, с')
+    workers.add_argument('--port', type=int, default=18081, help='порт fake_telegram.py')
+    workers.set_defaults(func=bench_workers)
+
+    metrics = commands.add_parser('metrics', help='цена измерений metrics.py')
+    metrics.add_argument('--updates', type=int, default=20_000, help='число обновлений')
+    metrics.add_argument('--chats', type=int, default=1000, help='число чатов')
+    metrics.add_argument('--show', action='store_true', help='вывести собранные метрики')
+    metrics.set_defaults(func=bench_metrics)
+
+    e2e = commands.add_parser('e2e', help='разговоры пользователей через fake_telegram.py')
+    e2e.add_argument('--conversations', type=int, default=1000, help='число разговоров, у каждого свой чат')
+    e2e.add_argument('--kinds', nargs='+', choices=['calories', 'registration', 'buying'],
+                     help='виды разговоров, по очереди (по умолчанию - все)')
+    e2e.add_argument('--rate', type=float, default=0, help='обновлений в секунду, 0 - без ограничения')
+    e2e.add_argument('--concurrency', type=int, default=100, help='число одновременных разговоров')
+    e2e.add_argument('--products', type=int, default=6, help='число продуктов в каталоге')
+    e2e.add_argument('--latency', type=float, default=0.005, help='задержка ответа fake_telegram.py, с')
+    e2e.add_argument('--port', type=int, default=18081, help='порт fake_telegram.py')
+    e2e.add_argument('--telegram-limits', action='store_true',
+                     help='лимиты Telegram на отправку в fake_telegram.py и в send_scheduler бота')
+    e2e.add_argument('--tracemalloc', action='store_true', help='пиковая память Python (замедляет бота)')
+    e2e.add_argument('--output', metavar='FILE', help='сохранить результаты в JSON для compare')
+    e2e.set_defaults(func=bench_e2e)
+
+    compare = commands.add_parser('compare', help='сравнить два файла результатов e2e')
+    compare.add_argument('old', help='результаты до изменения')
+    compare.add_argument('new', help='результаты после изменения')
+    compare.set_defaults(func=bench_compare)
+
+    limits = commands.add_parser('limits', help='всплеск отправки при лимитах Telegram, с send_scheduler и без')
+    limits.add_argument('--bulk', type=int, default=20, help='число чатов, открывших каталог')
+    limits.add_argument('--interactive', type=int, default=20, help='число чатов, нажавших кнопку покупки')
+    limits.add_argument('--spam', type=int, default=10, help='число чатов, приславших 5 сообщений подряд')
+    limits.add_argument('--products', type=int, default=6, help='число продуктов в каталоге')
+    limits.add_argument('--chat-rate', type=float, default=1.0, help='лимит сообщений в секунду в один чат')
+    limits.add_argument('--global-rate', type=float, default=30.0, help='лимит сообщений в секунду во все чаты')
+    limits.add_argument('--latency', type=float, default=0.02, help='задержка одного запроса к Bot API, с')
+    limits.set_defaults(func=bench_limits)
+
+    calories = commands.add_parser('calories', help='пакетный расчёт нормы калорий против цикла Python')
+    calories.add_argument('--rows', type=int, default=1_000_000, help='число строк')
+    calories.add_argument('--chunk-size', type=int, default=100_000, help='размер части при чтении CSV и SQLite')
+    calories.add_argument('--dir', default=None, help='каталог для CSV и базы данных (по умолчанию - временный)')
+    calories.set_defaults(func=bench_calories)
+
+    roundtrip = commands.add_parser('roundtrip', help='выгрузка и загрузка таблиц через table_io.py')
+    roundtrip.add_argument('--rows', type=int, default=10_000_000, help='число пользователей и продуктов')
+    roundtrip.add_argument('--formats', nargs='+', choices=['csv', 'jsonl', 'parquet'],
+                           default=['csv', 'jsonl', 'parquet'], help='форматы файлов')
+    roundtrip.add_argument('--dir', default=None, help='каталог для баз данных и файлов (по умолчанию - временный)')
+    roundtrip.set_defaults(func=bench_roundtrip)
+
+    images = commands.add_parser('images', help='подготовка картинок продуктов images.py')
+    images.add_argument('--photos', type=int, default=20, help='число больших фотографий с EXIF (нужен Pillow)')
+    images.add_argument('--sends', type=int, default=10_000, help='число отправок картинок')
+    images.add_argument('--dir', default=None, help='каталог для картинок (по умолчанию - временный)')
+    images.set_defaults(func=bench_images)
+
+    startup = commands.add_parser('startup', help='время запуска бота до ответа на первое обновление')
+    startup.add_argument('--runs', type=int, default=5, help='число запусков для каждого вида базы данных')
+    startup.add_argument('--target', type=float, default=1.0, help='цель: время до ответа на первое обновление, с')
+    startup.add_argument('--top', type=int, default=10, help='сколько самых долгих импортов показать')
+    startup.add_argument('--dir', default=None, help='каталог для баз данных (по умолчанию - временный)')
+    startup.set_defaults(func=bench_startup)
+
+    purchases = commands.add_parser('purchases', help='одновременные покупки из нескольких процессов')
+    purchases.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4], help='число процессов покупателей')
+    purchases.add_argument('--purchases', type=int, default=20_000, help='число покупок всего')
+    purchases.add_argument('--users', type=int, default=100,
+                           help='число покупателей: меньше - чаще покупки одного пользователя одновременно')
+    purchases.add_argument('--products', type=int, default=10, help='число продуктов, цены от 1 до products')
+    purchases.add_argument('--dir', default=None, help='каталог для базы данных (по умолчанию - временный)')
+    purchases.set_defaults(func=bench_purchases)
+
+    routing = commands.add_parser('routing', help='выбор обработчика: перебор фильтров против routing.py')
+    routing.add_argument('--handlers', type=int, nargs='+', default=[10, 100, 500],
+                         help='число обработчиков текста и обработчиков кнопок')
+    routing.add_argument('--updates', type=int, default=5000, help='число обновлений')
+    routing.add_argument('--chats', type=int, default=100, help='число чатов, в каждом десятом - состояние FSM')
+    routing.set_defaults(func=bench_routing)
+
+    soak = commands.add_parser('soak', help='память и файл состояний FSM при брошенных разговорах')
+    soak.add_argument('--flows', type=int, default=2_000_000, help='число брошенных разговоров')
+    soak.add_argument('--report', type=int, default=100_000, help='через сколько разговоров печатать строку')
+    soak.add_argument('--storage', choices=['sqlite', 'memory'], default='sqlite')
+    soak.add_argument('--ttl', type=float, default=5.0, help='через сколько секунд разговор считается брошенным')
+    soak.add_argument('--expire-interval', type=float, default=1.0, help='как часто удалять брошенные разговоры, с')
+    soak.add_argument('--cache-size', type=int, default=10_000, help='разговоров в памяти SQLiteStorage')
+    soak.add_argument('--memory-budget', type=int, default=2 * 2**20, help='байт данных разговоров в памяти')
+    soak.add_argument('--max-bytes', type=int, default=4_000_000, help='байт данных разговоров в базе')
+    soak.add_argument('--dir', default=None, help='каталог для базы данных (по умолчанию - временный)')
+    soak.set_defaults(func=bench_soak)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+норма калорий по формуле Миффлина - Сан Жеора
+
+    calc_calories           - для одного человека, используется ботом
+    calc_calories_batch     - для столбцов значений за один проход NumPy (без NumPy - циклом Python)
+    csv_chunks, sqlite_chunks, calories_stream - для таблиц любого размера по частям, память не растёт с числом строк
+
+Пакетный расчёт даёт те же числа, что и calc_calories, до последнего бита: операции те же и в том же порядке.
+
+Запуск:
+    python calories.py csv cohort.csv [--output calories.csv]
+    python calories.py sqlite cohort.db "SELECT gender, age, growth, weight FROM Cohort" [--output calories.csv]
+"""
+import csv
+import sqlite3
+import argparse
+from functools import lru_cache
+from itertools import islice
+from typing import Iterable, Iterator, Sequence
+
+
+male_offset = 5.0
+female_offset = -161.0
+
+Columns = tuple[Sequence, Sequence, Sequence, Sequence]     # (gender, age, growth, weight)
+
+
+@lru_cache(maxsize=None)
+def numpy():
+    """
+    :return: модуль numpy или None, если он не установлен
+    """
+    # импорт при первом пакетном расчёте: боту нужен только calc_calories, а numpy - самый долгий импорт при запуске
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def calc_calories(gender: str, age: float, growth: float, weight: float) -> float:
+    """
+    формула Миффлина - Сан Жеора для подсчёта нормы калорий для женщин или мужчин
+    :param gender: пол, 'M' или 'F'
+    :param age: возраст в годах
+    :param growth: рост в см
+    :param weight: вес в кг
+    :return: норма калорий
+    """
+    # (10 х вес в кг) + (6, 25 х рост в см) – (5 х возраст в г) + 5(M) или -161(F).
+    return (10.0 * weight) + (6.25 * growth) - (5.0 * age) + (male_offset if gender == 'M' else female_offset)
+
+
+def calc_calories_batch(gender: Sequence, age: Sequence, growth: Sequence, weight: Sequence):
+    """
+    норма калорий для столбцов значений одинаковой длины
+    :return: массив NumPy float64, без NumPy - список
+    """
+    np = numpy()
+    if np is None:
+        return [calc_calories(*row) for row in zip(gender, age, growth, weight)]
+
+    weight = np.asarray(weight, dtype=np.float64)
+    growth = np.asarray(growth, dtype=np.float64)
+    age = np.asarray(age, dtype=np.float64)
+    offset = np.where(np.asarray(gender) == 'M', male_offset, female_offset)
+    # те же операции в том же порядке, что и в calc_calories
+    result = 10.0 * weight
+    result += 6.25 * growth
+    result -= 5.0 * age
+    result += offset
+    return result
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# данные по частям
+
+def rows_to_columns(rows: list[tuple]) -> Columns:
+    return tuple(zip(*rows)) if rows else ((), (), (), ())
+
+
+def csv_chunks(file, chunk_size: int = 100_000) -> Iterator[Columns]:
+    """
+    :param file:        открытый CSV-файл со столбцами gender, age, growth, weight и строкой заголовка
+    :param chunk_size:  число строк в части
+    :return:            части по chunk_size строк
+    """
+    reader = csv.DictReader(file)
+    rows = ((row['gender'], row['age'], row['growth'], row['weight']) for row in reader)
+    while chunk := list(islice(rows, chunk_size)):
+        yield rows_to_columns(chunk)
+
+
+def sqlite_chunks(db: sqlite3.Connection, query: str, params: tuple = (), chunk_size: int = 100_000
+                  ) -> Iterator[Columns]:
+    """
+    :param query:       запрос, возвращающий столбцы gender, age, growth, weight
+    :param chunk_size:  число строк в части
+    :return:            части по chunk_size строк
+    """
+    cursor = db.execute(query, params)
+    while chunk := cursor.fetchmany(chunk_size):
+        yield rows_to_columns(chunk)
+
+
+def calories_stream(chunks: Iterable[Columns]) -> Iterator:
+    """
+    :return: нормы калорий для каждой части
+    """
+    for gender, age, growth, weight in chunks:
+        if numpy() is None:
+            # из CSV приходят строки
+            age, growth, weight = ([float(value) for value in column] for column in (age, growth, weight))
+        yield calc_calories_batch(gender, age, growth, weight)
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    from_csv = commands.add_parser('csv', help='CSV со столбцами gender, age, growth, weight')
+    from_csv.add_argument('file')
+    from_sqlite = commands.add_parser('sqlite', help='запрос к базе данных SQLite')
+    from_sqlite.add_argument('database')
+    from_sqlite.add_argument('query', help='запрос, возвращающий столбцы gender, age, growth, weight')
+    for command in (from_csv, from_sqlite):
+        command.add_argument('--chunk-size', type=int, default=100_000, help='число строк в части')
+        command.add_argument('--output', help='CSV с нормой калорий для каждой строки')
+    args = parser.parse_args()
+
+    if args.command == 'csv':
+        source = open(args.file, newline='', encoding='utf-8')
+        chunks = csv_chunks(source, args.chunk_size)
+    else:
+        source = sqlite3.connect(args.database)
+        chunks = sqlite_chunks(source, args.query, chunk_size=args.chunk_size)
+    output = open(args.output, 'w', newline='', encoding='utf-8') if args.output else None
+
+    count, total, low, high = 0, 0.0, float('inf'), float('-inf')
+    try:
+        if output:
+            output.write('calories\n')
+        for calories in calories_stream(chunks):
+            if numpy() is not None:
+                calories = calories.tolist()
+            count += len(calories)
+            total += sum(calories)
+            low, high = min(low, min(calories)), max(high, max(calories))
+            if output:
+                output.writelines(f'{value!r}\n' for value in calories)
+    finally:
+        source.close()
+        if output:
+            output.close()
+
+    if count:
+        print(f'rows={count} mean={total / count:.1f} min={low:.1f} max={high:.1f}')
+    else:
+        print('rows=0')
+
+
+if __name__ == '__main__':
+    main()
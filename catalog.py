@@ -0,0 +1,110 @@
+#-----------------------------------------------------------------------------------------------------------------------
+# каталог продуктов в памяти бота
+#
+# Каталог перечитывается из таблицы Products, только когда она изменилась (см. crud_functions.products_version).
+# Подписи и клавиатуры строятся один раз на версию каталога, а не на каждое нажатие "Купить".
+# Картинки продуктов готовятся (images.prepared_name) и читаются в память (images.load) при загрузке каталога,
+# в потоке чтения базы данных (Catalog.prepare), а не в цикле событий и не при каждой отправке.
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+import images
+
+
+class ProductRecord:
+    """
+    продукт каталога с готовой подписью к картинке
+    """
+    __slots__ = ('id', 'title', 'description', 'price', 'image', 'caption')
+
+    def __init__(self, id: int, title: str, description: str, price: int, image: str):
+        self.id = id
+        self.title = title
+        self.description = description
+        self.price = price
+        self.image = image
+        self.caption = f'Название: {title} | Описание: {description} | Цена: {price}'
+
+
+class Catalog:
+    """
+    снимок таблицы Products одной версии
+    """
+    def __init__(self, page_size: int):
+        """
+        :param page_size:   число продуктов на странице каталога
+        """
+        self.page_size = page_size
+        self.version = None         # версия таблицы Products, из которой загружен снимок
+        self.products: list[ProductRecord] = []
+        self.by_id: dict[int, ProductRecord] = {}
+        self.keyboards: dict[int | None, InlineKeyboardMarkup] = {}
+
+    @staticmethod
+    def prepare(products: list[tuple]) -> list[ProductRecord]:
+        """
+        читает файлы картинок, поэтому выполняется не в цикле событий
+        :param products:    записи (id, title, description, price, image)
+        :return:            продукты с подготовленными картинками, уже прочитанными в память
+        """
+        records = [ProductRecord(*product) for product in products]
+        for product in records:
+            product.image = images.prepared_name(product.image)
+            images.load(product.image)
+        return records
+
+    def load(self, version, products: list[ProductRecord]):
+        """
+        :param version:     версия таблицы Products
+        :param products:    продукты из prepare
+        """
+        self.products = products
+        self.by_id = {product.id: product for product in self.products}
+        self.keyboards = {}
+        self.version = version
+
+    @property
+    def page_count(self) -> int:
+        return max(1, -(-len(self.products) // self.page_size))
+
+    def find(self, key: str) -> ProductRecord | None:
+        """
+        :param key: id продукта из callback_data; в клавиатурах, отправленных до перехода на id, - название
+        """
+        if key.isdigit():
+            return self.by_id.get(int(key))
+        return next((product for product in self.products if product.title == key), None)
+
+    def page(self, page: int) -> list[ProductRecord]:
+        """
+        :param page:    номер страницы каталога, начиная с 0
+        """
+        first = page * self.page_size
+        return self.products[first:first + self.page_size]
+
+    def keyboard(self, page: int | None = None) -> InlineKeyboardMarkup:
+        """
+        :param page:    номер страницы каталога, None - весь каталог
+        :return:        кнопки покупки продуктов и, если страниц несколько, кнопки навигации
+        """
+        if page not in self.keyboards:
+            self.keyboards[page] = self._build_keyboard(page)
+        return self.keyboards[page]
+
+    def _build_keyboard(self, page: int | None) -> InlineKeyboardMarkup:
+        products = self.products if page is None else self.page(page)
+
+        kb = InlineKeyboardMarkup()
+        kb.add(*[InlineKeyboardButton(text=product.title, callback_data=f"product_buying {product.id}")
+                 for product in products])
+        if page is None:
+            return kb
+
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton(text='<', callback_data=f"product_page {page - 1}"))
+        if page + 1 < self.page_count:
+            navigation.append(InlineKeyboardButton(text='>', callback_data=f"product_page {page + 1}"))
+        if navigation:
+            kb.row(*navigation)
+        return kb
@@ -1,22 +1,112 @@
 #-----------------------------------------------------------------------------------------------------------------------
 # database common
 
+import os
+import time
+import hashlib
 import sqlite3
+import threading
+from functools import lru_cache
 from sqlite3 import Connection as Db
+from typing import Iterable, Iterator
+
+import images
 
 
 db_id               = 'INTEGER PRIMARY KEY'
+db_text_key         = 'TEXT PRIMARY KEY'
 db_text             = 'TEXT'
 db_text_not_null    = 'TEXT NOT NULL'
 db_int              = 'INTEGER'
 db_int_not_null     = 'INTEGER NOT NULL'
 
 
-def open_db(database_name: str) -> Db:
-    db = sqlite3.connect(database_name)
+# PRAGMA для каждого нового соединения
+db_pragmas = {
+    'journal_mode': 'WAL',      # читатели не ждут писателя и наоборот
+    'synchronous':  'NORMAL',   # в режиме WAL не теряет целостность, теряются только последние транзакции при сбое ОС
+    'cache_size':   -16_000,    # кэш страниц, отрицательное значение - в КиБ
+    'mmap_size':    64 * 2**20, # чтение файла базы данных через mmap, байт
+    'busy_timeout': 5000,       # сколько ждать, пока пишет другой процесс, мс
+}
+db_cached_statements = 256      # сколько подготовленных запросов хранит каждое соединение
+
+
+def open_db(database_name: str, read_only: bool = False) -> Db:
+    # соединение используется и из потока базы данных async_crud_functions
+    db = sqlite3.connect(database_name, check_same_thread=False, cached_statements=db_cached_statements)
+    for name, value in db_pragmas.items():
+        db.execute(f'PRAGMA {name} = {value}')
+    if read_only:
+        db.execute('PRAGMA query_only = ON')
     return db
 
 
+class ConnectionPool:
+    """
+    соединения с одной базой данных: одно пишущее на весь процесс и по одному читающему на каждый поток
+    """
+    def __init__(self, database_name: str):
+        self.database_name = database_name
+        self.writer = open_db(database_name)
+        self.readers: list[Db] = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def reader(self) -> Db:
+        """
+        :return: читающее соединение текущего потока
+        """
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = open_db(self.database_name, read_only=True)
+            with self.lock:
+                self.readers.append(db)
+        return db
+
+    def close(self):
+        with self.lock:
+            for db in self.readers:
+                db.close()
+            self.readers.clear()
+        self.local = threading.local()
+        self.writer.close()
+
+
+# Текст запросов строится один раз: дальше sqlite3 находит по нему уже подготовленный запрос в кэше соединения.
+
+@lru_cache(maxsize=None)
+def insert_sql(table: str, keys: str, conflict: str = '') -> str:
+    return f'INSERT {conflict} INTO {table} ({keys}) VALUES ({",".join("?"*len(keys.split()))})'
+
+
+@lru_cache(maxsize=None)
+def select_sql(table: str, cond: str, fields: str) -> str:
+    return f'SELECT {fields} FROM {table} WHERE {cond}'
+
+
+@lru_cache(maxsize=None)
+def update_sql(table: str, assignments: str, cond: str, returning: str = '') -> str:
+    return f'UPDATE {table} SET {assignments} WHERE {cond}' + (f' RETURNING {returning}' if returning else '')
+
+
+@lru_cache(maxsize=None)
+def exists_sql(table: str, cond: str) -> str:
+    return f'SELECT EXISTS (SELECT 1 FROM {table} WHERE {cond})'
+
+
+# функции, вызываемые после каждого запроса вспомогательных функций ниже: hook(операция, таблица, секунды),
+# например metrics.observe_query
+query_hooks: list = []
+
+
+def query_done(operation: str, table: str, start: float):
+    if query_hooks:
+        seconds = time.perf_counter() - start
+        for hook in query_hooks:
+            hook(operation, table, seconds)
+
+
 def create_table(db: Db, table: str, keys: str):
     """
     :param db:      соединение с базой данных
@@ -27,22 +117,94 @@ def create_table(db: Db, table: str, keys: str):
     cursor.execute(f'CREATE TABLE IF NOT EXISTS {table} ({keys})')
 
 
-def insert_to_db(db: Db, table: str, keys: str, params: tuple):
+def insert_to_db(db: Db, table: str, keys: str, params: tuple, conflict: str = '') -> int:
+    """
+    :param conflict:    поведение при нарушении ограничений, например 'OR IGNORE'
+    :return:            число добавленных записей
+    """
+    start = time.perf_counter()
     cursor = db.cursor()
-    cmd = f'INSERT INTO {table} ({keys}) VALUES ({",".join("?"*len(keys.split()))})'
-    cursor.execute(cmd, params)
+    cursor.execute(insert_sql(table, keys, conflict), params)
+    query_done('insert', table, start)
+    return cursor.rowcount
+
+
+def insert_many_to_db(db: Db, table: str, keys: str, rows: Iterable[tuple], conflict: str = '') -> int:
+    """
+    :param rows:        последовательность или итератор кортежей значений, читается по мере вставки
+    :param conflict:    поведение при нарушении ограничений, например 'OR IGNORE'
+    :return:            число добавленных записей
+    """
+    start = time.perf_counter()
+    cursor = db.cursor()
+    cursor.executemany(insert_sql(table, keys, conflict), rows)
+    query_done('insert_many', table, start)
+    return cursor.rowcount
+
+
+def replace_in_db(db: Db, table: str, keys: str, params: tuple):
+    start = time.perf_counter()
+    cursor = db.cursor()
+    cursor.execute(insert_sql(table, keys, 'OR REPLACE'), params)
+    query_done('replace', table, start)
+
+
+def update_in_db(db: Db, table: str, assignments: str, cond: str, params: tuple = (), returning: str = '') -> list:
+    """
+    :param assignments: присваивания через запятую, например 'balance = balance - ?'
+    :param params:      значения для assignments, затем для cond
+    :param returning:   столбцы изменённых записей, которые нужно вернуть
+    :return:            значения returning для каждой изменённой записи
+    """
+    start = time.perf_counter()
+    cursor = db.cursor()
+    cursor.execute(update_sql(table, assignments, cond, returning), params)
+    records = cursor.fetchall()
+    query_done('update', table, start)
+    return records
 
 
 def delete_from_db(db: Db, table: str, cond: str = 'TRUE', params: tuple = ()):
+    start = time.perf_counter()
     cursor = db.cursor()
     cmd = f'DELETE FROM {table} WHERE {cond}'
     cursor.execute(cmd, params)
+    query_done('delete', table, start)
+
+
+def exists_in_db(db: Db, table: str, cond: str, params: tuple = ()) -> bool:
+    """
+    :return: True, если в таблице есть хотя бы одна запись, удовлетворяющая условию
+    """
+    start = time.perf_counter()
+    cursor = db.cursor()
+    cursor.execute(exists_sql(table, cond), params)
+    exists = cursor.fetchone()[0] == 1
+    query_done('exists', table, start)
+    return exists
 
 
 def fetch_records_from_db(db: Db, table: str, cond: str = 'TRUE', params: tuple = (), fields: str = '*') -> list:
+    start = time.perf_counter()
     cursor = db.cursor()
-    cursor.execute(f'SELECT {fields} FROM {table} WHERE {cond}', params)
-    return cursor.fetchall()
+    cursor.execute(select_sql(table, cond, fields), params)
+    records = cursor.fetchall()
+    query_done('select', table, start)
+    return records
+
+
+def iter_records_from_db(db: Db, table: str, cond: str = 'TRUE', params: tuple = (), fields: str = '*',
+                         chunk_size: int = 10_000) -> Iterator[tuple]:
+    """
+    читает записи по мере перебора, в памяти - не больше chunk_size записей
+    :param chunk_size:  сколько записей читать за один fetchmany
+    """
+    start = time.perf_counter()
+    cursor = db.cursor()
+    cursor.execute(select_sql(table, cond, fields), params)
+    query_done('select_stream', table, start)
+    while records := cursor.fetchmany(chunk_size):
+        yield from records
 
 
 #-----------------------------------------------------------------------------------------------------------------------
@@ -69,6 +231,23 @@ def create_products_table(db: Db, table: str, keys: TableKeys):
     create_table(db, table, keys)
 
 
+# счётчик изменений таблицы Products: одна строка, её увеличивают триггеры на каждую добавленную, изменённую
+# или удалённую запись Products, каким бы соединением или процессом она ни была изменена
+products_version_table = 'ProductsVersion'
+
+
+def migrate_products_version(db: Db):
+    """
+    таблица ProductsVersion и триггеры, которые её обновляют
+    """
+    create_table(db, products_version_table, 'id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL')
+    db.execute(f'INSERT OR IGNORE INTO {products_version_table} VALUES (0, 0)')
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        db.execute(f'CREATE TRIGGER IF NOT EXISTS {products_table}_{event.lower()}_version '
+                   f'AFTER {event} ON {products_table} '
+                   f'BEGIN UPDATE {products_version_table} SET version = version + 1; END')
+
+
 #-----------------------------------------------------------------------------------------------------------------------
 # users
 
@@ -80,6 +259,7 @@ users_keys = (
     ('email',       db_text_not_null),
     ('age',         db_int_not_null),
     ('balance',     db_int_not_null),
+    ('telegram_id', db_int),            # id пользователя Telegram, NULL - пользователь добавлен не через бота
 )
 
 
@@ -88,10 +268,202 @@ def create_users_table(db: Db, table: str, keys: TableKeys):
     create_table(db, table, keys)
 
 
+class MigrationError(RuntimeError):
+    """
+    миграция не может быть применена к данным базы; база данных остаётся в прежней версии
+    """
+
+
+def migrate_unique_users(db: Db):
+    """
+    уникальные индексы на username и email
+    """
+    # до появления индексов в таблицу могли попасть повторы. Какую из записей оставить, решает администратор:
+    # миграция ничего не удаляет и останавливается, перечислив все повторы
+    conflicts = []
+    for key_name in ('username', 'email'):
+        for value, ids in db.execute(f"SELECT {key_name}, GROUP_CONCAT(id, ', ') FROM {users_table} "
+                                     f'GROUP BY {key_name} HAVING COUNT(*) > 1 ORDER BY MIN(id)'):
+            conflicts.append(f'{key_name} {value!r}: id {ids}')
+    if conflicts:
+        raise MigrationError(f'{users_table} has duplicate usernames or emails, unique indexes not created. '
+                             'Remove or rename the duplicates and restart:\n    ' + '\n    '.join(conflicts))
+
+    for key_name in ('username', 'email'):
+        db.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {users_table}_{key_name} ON {users_table} ({key_name})')
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# purchases: журнал покупок, записи только добавляются
+
+purchases_table = 'Purchases'
+purchases_keys = (
+    ('id',          db_id),             # первичный ключ
+    ('user_id',     db_int_not_null),   # Users.id
+    ('product_id',  db_int_not_null),   # Products.id
+    ('price',       db_int_not_null),   # списанная сумма: цена продукта в момент покупки
+    ('time',        'REAL NOT NULL'),   # время покупки, с от начала эпохи
+)
+
+
+def migrate_purchases(db: Db):
+    """
+    столбец Users.telegram_id и журнал покупок
+    """
+    # в новой базе данных столбец уже создан create_users_table
+    if 'telegram_id' not in [row[1] for row in db.execute(f'PRAGMA table_info({users_table})')]:
+        db.execute(f'ALTER TABLE {users_table} ADD COLUMN telegram_id {db_int}')
+    db.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {users_table}_telegram_id ON {users_table} (telegram_id)')
+
+    create_table(db, purchases_table, ', '.join([f'{key_name} {key_type}' for key_name, key_type in purchases_keys]))
+    db.execute(f'CREATE INDEX IF NOT EXISTS {purchases_table}_user ON {purchases_table} (user_id, time)')
+    db.execute(f'CREATE INDEX IF NOT EXISTS {purchases_table}_time ON {purchases_table} (time)')
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# media cache: file_id загруженных в Telegram картинок
+
+media_table = 'Media'
+media_keys = (
+    ('image',       db_text_key),       # имя файла картинки
+    ('file_id',     db_text_not_null),  # file_id, выданный Telegram после первой загрузки
+    ('mtime',       db_int_not_null),   # время изменения файла, нс
+    ('hash',        db_text_not_null),  # sha1 содержимого файла
+)
+
+
+def create_media_table(db: Db, table: str, keys: TableKeys):
+    keys = ', '.join([f'{key_name} {key_type}' for key_name, key_type in keys])
+    create_table(db, table, keys)
+
+
+def file_hash(filename: str) -> str:
+    """
+    :param filename:    имя файла
+    :return:            sha1 содержимого файла
+    """
+    with open(filename, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# таблицы, которые можно выгрузить и загрузить целиком (table_io.py)
+table_keys = {
+    products_table: products_keys,
+    users_table:    users_keys,
+}
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# миграции схемы
+#
+# Версия схемы хранится в PRAGMA user_version. migrations[i] переводит базу данных с версии i на версию i+1,
+# новые миграции добавляются только в конец. База данных версии len(migrations) считается готовой, и initiate_db
+# не выполняет для неё никаких CREATE, поэтому новая таблица или индекс тоже добавляется миграцией.
+migrations = (
+    migrate_unique_users,
+    migrate_purchases,
+    migrate_products_version,
+)
+
+
+def schema_version(db: Db) -> int:
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate_db(db: Db):
+    """
+    применяет к базе данных недостающие миграции, каждую в своей транзакции
+    """
+    # sqlite3 сам не начинает транзакцию перед DDL, и внутри with db каждый ALTER/CREATE фиксировался бы сразу.
+    # Поэтому транзакция открывается явно. BEGIN IMMEDIATE сразу берёт блокировку записи: если миграции
+    # одновременно запускают несколько процессов, остальные ждут и, перечитав user_version, не повторяют уже
+    # применённую миграцию
+    while True:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            version = schema_version(db)
+            if version >= len(migrations):
+                db.rollback()
+                return
+            migrations[version](db)
+            db.execute(f'PRAGMA user_version = {version + 1}')
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+
+
 #-----------------------------------------------------------------------------------------------------------------------
 # global db
 database_filename = 'database.db'
-global_db: Db
+db_pool: ConnectionPool
+global_db: Db       # пишущее соединение db_pool, читать - через db_pool.reader()
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# отложенная запись
+#
+# durability задаёт, когда добавленные add_user/add_product записи попадают на диск:
+#   'commit'  - сразу: отдельная транзакция на каждую запись (по умолчанию)
+#   'batched' - записи копятся в очереди и пишутся одной транзакцией через executemany, как только в очереди
+#               write_batch_size записей или с первой из них прошло write_flush_interval секунд.
+#               Записи, нарушающие уникальность username/email, пропускаются, не мешая остальным.
+#               Если процесс упадёт, теряются ещё не записанные записи: не больше write_batch_size
+#               и не старше write_flush_interval секунд. Очередь записывают flush_writes и close_db.
+#
+# Функции чтения (get_all_products, get_products_if_changed, is_registered, is_included, lookup_media_file_id)
+# обращаются только к читающему соединению своего потока и не трогают global_db и очередь, поэтому их можно
+# вызывать из нескольких потоков одновременно с записью. Очередь они не видят: в режиме 'batched' перед чтением
+# нужно вызвать flush_writes (async_crud_functions делает это сам).
+durability = 'commit'
+write_batch_size = 100
+write_flush_interval = 1.0
+
+pending_writes: dict[tuple[str, str], list[tuple]] = {}     # (таблица, ключи) -> строки
+pending_count = 0
+pending_since = 0.0
+
+
+def queue_insert(table: str, keys: str, params: tuple):
+    """
+    добавляет запись в таблицу в соответствии с durability
+    """
+    global pending_count, pending_since
+    if durability == 'commit':
+        insert_to_db(global_db, table, keys, params, 'OR IGNORE')
+        global_db.commit()
+        return
+
+    if not pending_count:
+        pending_since = time.monotonic()
+    pending_writes.setdefault((table, keys), []).append(params)
+    pending_count += 1
+
+    if pending_count >= write_batch_size or time.monotonic() - pending_since >= write_flush_interval:
+        flush_writes()
+
+
+def flush_writes():
+    """
+    записывает очередь отложенных записей одной транзакцией
+    """
+    global pending_count
+    if not pending_count:
+        return
+
+    with global_db:
+        for (table, keys), rows in pending_writes.items():
+            insert_many_to_db(global_db, table, keys, rows, 'OR IGNORE')
+    pending_writes.clear()
+    pending_count = 0
+
+
+def flush_writes_due() -> bool:
+    """
+    :return: True, если в очереди есть записи старше write_flush_interval секунд
+    """
+    return pending_count != 0 and time.monotonic() - pending_since >= write_flush_interval
 
 
 def initiate_db():
@@ -99,19 +471,26 @@ def initiate_db():
     создаёт:
         - таблицу Products, если она ещё не создана при помощи SQL запроса.
         - таблицу Users, если она ещё не создана при помощи SQL запроса.
+        - таблицу Media, если она ещё не создана при помощи SQL запроса.
     """
-    global global_db
-    global_db = open_db(database_filename)
+    global db_pool, global_db
+    db_pool = ConnectionPool(database_filename)
+    global_db = db_pool.writer
 
+    if schema_version(global_db) == len(migrations):
+        return          # схема актуальна - при запуске обходимся без DDL
     create_products_table(global_db, products_table, products_keys)
     create_users_table(global_db, users_table, users_keys)
+    create_media_table(global_db, media_table, media_keys)
+    migrate_db(global_db)
 
 
 def close_db():
     """
-    закрывает базу данных
+    закрывает базу данных, предварительно записав очередь отложенных записей
     """
-    global_db.close()
+    flush_writes()
+    db_pool.close()
 
 
 def clear_db():
@@ -119,45 +498,143 @@ def clear_db():
     очищает базу данных:
         - таблицу Products
         - таблицу Users
+        - таблицу Media
+        - таблицу Purchases
     """
     delete_from_db(global_db, products_table)
     delete_from_db(global_db, users_table)
+    delete_from_db(global_db, media_table)
+    delete_from_db(global_db, purchases_table)
+    global_db.commit()
 
 
-def get_all_products() -> list[Product]:
+def get_all_products(with_id: bool = False) -> list[Product]:
     """
-    :return: все записи из таблицы Products
+    :param with_id: добавить в начало каждой записи id продукта
+    :return:        все записи из таблицы Products
     """
-    # skip id
-    products = [product[1:] for product in fetch_records_from_db(global_db, products_table)]
-#     key_names = ', '.join([key_name for key_name, _ in products_keys][1:])
-#     products = fetch_records_from_db(global_db, products_table, fields=key_names)
+    key_names = ', '.join([key_name for key_name, _ in products_keys][0 if with_id else 1:])
+    products = fetch_records_from_db(db_pool.reader(), products_table, fields=key_names)
     return products
 
 
+def products_version() -> int:
+    """
+    :return: версия таблицы Products - меняется при изменении таблицы этим или любым другим соединением
+    """
+    # PRAGMA data_version читающего соединения меняется после изменения любой таблицы любым другим соединением,
+    # в том числе global_db. Только тогда читается счётчик ProductsVersion: регистрации и покупки в других
+    # процессах меняют data_version, но не версию Products
+    db = db_pool.reader()
+    data_version = db.execute('PRAGMA data_version').fetchone()[0]
+    local = db_pool.local
+    if getattr(local, 'data_version', None) != data_version:
+        records = fetch_records_from_db(db, products_version_table, 'id == 0', fields='version')
+        local.products_version = records[0][0]
+        local.data_version = data_version
+    return local.products_version
+
+
+def get_products_if_changed(version: int | None) -> tuple[int, list[Product] | None]:
+    """
+    :param version: версия таблицы Products, уже имеющаяся у вызывающего
+    :return:        текущая версия и записи (id, title, description, price, image) или None, если версия не изменилась
+    """
+    current = products_version()
+    if current == version:
+        return current, None
+    return current, get_all_products(with_id=True)
+
+
 def add_product(title: str, description: str, price: int, image: str):
     """
     :param title:       название товара
     :param description: описание
     :param price:       цена
-    :param image:       фотография
+    :param image:       фотография, в таблицу записывается подготовленная images.prepare_image копия
     """
     key_names = ', '.join([key_name for key_name, _ in products_keys][1:])
-    insert_to_db(global_db, products_table, key_names, (title, description, price, image))
-    global_db.commit()
+    queue_insert(products_table, key_names, (title, description, price, images.prepare_image(image)))
 
 
 def add_user(username: str, email: str, age: int):
     """
     добавлять в таблицу Users вашей БД запись с переданными данными
+    Если username или email уже заняты, запись не добавляется.
     :param username:    имя пользователя
     :param email:       почта
     :param age:         возраст
     """
     key_names = ', '.join([key_name for key_name, _ in users_keys][1:])
     # Баланс у новых пользователей всегда равен 1000.
-    insert_to_db(global_db, users_table, key_names, (username, email, age, 1000))
+    queue_insert(users_table, key_names, (username, email, age, 1000, None))
+
+
+def register_user(username: str, email: str, age: int, telegram_id: int | None = None) -> bool:
+    """
+    добавляет пользователя сразу, независимо от durability: проверка и добавление - один INSERT,
+    поэтому два одновременных пользователя не могут зарегистрировать одно и то же имя
+    :param username:    имя пользователя
+    :param email:       почта
+    :param age:         возраст
+    :param telegram_id: id пользователя Telegram, по нему находится покупатель
+    :return:            True, если пользователь добавлен, False - если username, email или telegram_id уже заняты
+    """
+    flush_writes()
+    key_names = ', '.join([key_name for key_name, _ in users_keys][1:])
+    added = insert_to_db(global_db, users_table, key_names, (username, email, age, 1000, telegram_id), 'OR IGNORE')
     global_db.commit()
+    return added == 1
+
+
+def is_registered(telegram_id: int) -> bool:
+    """
+    :return: True, если пользователь Telegram уже зарегистрирован
+    """
+    return exists_in_db(db_pool.reader(), users_table, 'telegram_id == ?', (telegram_id,))
+
+
+# результаты buy_product
+purchase_done = 'done'
+purchase_no_user = 'no_user'            # пользователь Telegram не зарегистрирован
+purchase_no_product = 'no_product'      # продукта уже нет в таблице Products
+purchase_no_money = 'no_money'          # баланса не хватает на покупку
+
+
+def buy_product(telegram_id: int, product_id: int) -> tuple[str, int | None]:
+    """
+    списывает цену продукта с баланса пользователя и записывает покупку в журнал Purchases - одной транзакцией
+    Баланс уменьшается одним UPDATE ... WHERE balance >= price, поэтому одновременные покупки того же пользователя,
+    в том числе из других процессов бота, не уводят баланс в минус.
+    :param telegram_id: id пользователя Telegram
+    :param product_id:  Products.id
+    :return:            (purchase_done или причина отказа, баланс пользователя после покупки или None)
+    """
+    flush_writes()
+    # блокировка записи с начала транзакции: цена, списание и запись журнала видят одно и то же состояние базы,
+    # а другой процесс ждёт busy_timeout, вместо того чтобы получить ошибку посреди транзакции
+    global_db.execute('BEGIN IMMEDIATE')
+    try:
+        records = fetch_records_from_db(global_db, products_table, 'id == ?', (product_id,), 'price')
+        if not records:
+            result = purchase_no_product, None
+        else:
+            price = records[0][0]
+            debited = update_in_db(global_db, users_table, 'balance = balance - ?',
+                                   'telegram_id == ? AND balance >= ?', (price, telegram_id, price), 'id, balance')
+            if debited:
+                user_id, balance = debited[0]
+                key_names = ', '.join([key_name for key_name, _ in purchases_keys][1:])
+                insert_to_db(global_db, purchases_table, key_names, (user_id, product_id, price, time.time()))
+                result = purchase_done, balance
+            else:
+                records = fetch_records_from_db(global_db, users_table, 'telegram_id == ?', (telegram_id,), 'balance')
+                result = (purchase_no_money, records[0][0]) if records else (purchase_no_user, None)
+        global_db.commit()
+    except BaseException:
+        global_db.rollback()
+        raise
+    return result
 
 
 def is_included(username: str):
@@ -166,19 +643,135 @@ def is_included(username: str):
     :return:            True, если такой пользователь есть в таблице Users в противном случае False
     """
     # Для получения записей используйте SQL запрос.
-    records = fetch_records_from_db(global_db, users_table, 'username == ?', (username,))
-    return len(records) != 0
+    return exists_in_db(db_pool.reader(), users_table, 'username == ?', (username,))
+
+
+def lookup_media_file_id(image: str) -> tuple[str | None, bool]:
+    """
+    только чтение
+    :param image:   имя файла картинки
+    :return:        (file_id, False), если файл не менялся с момента загрузки; (None, False), если file_id нет;
+                    (None, True), если время изменения файла другое - нужна проверка check_media_file_id
+    """
+    try:
+        mtime = os.stat(image).st_mtime_ns
+    except OSError:
+        return None, False
+
+    records = fetch_records_from_db(db_pool.reader(), media_table, 'image == ?', (image,), 'file_id, mtime')
+    if not records:
+        return None, False
+    file_id, cached_mtime = records[0]
+    if mtime == cached_mtime:
+        return file_id, False
+    return None, True
+
+
+def check_media_file_id(image: str) -> str | None:
+    """
+    проверяет содержимое картинки, время изменения которой не совпадает с сохранённым
+    :return:        сохранённый file_id, если содержимое не менялось, иначе None - и file_id забывается
+    """
+    try:
+        mtime = os.stat(image).st_mtime_ns
+    except OSError:
+        return None
+
+    records = fetch_records_from_db(global_db, media_table, 'image == ?', (image,), 'file_id, hash')
+    if not records:
+        return None
+
+    # файл трогали - проверяем содержимое, а не только время изменения
+    file_id, cached_hash = records[0]
+    if file_hash(image) != cached_hash:
+        delete_from_db(global_db, media_table, 'image == ?', (image,))
+        global_db.commit()
+        return None
+
+    replace_in_db(global_db, media_table, 'image, file_id, mtime, hash', (image, file_id, mtime, cached_hash))
+    global_db.commit()
+    return file_id
+
+
+def get_media_file_id(image: str) -> str | None:
+    """
+    :param image:   имя файла картинки
+    :return:        сохранённый file_id, если файл не менялся с момента загрузки, иначе None
+    """
+    file_id, touched = lookup_media_file_id(image)
+    return check_media_file_id(image) if touched else file_id
+
+
+def set_media_file_id(image: str, file_id: str):
+    """
+    запоминает file_id картинки после её загрузки в Telegram
+    :param image:   имя файла картинки
+    :param file_id: file_id, выданный Telegram
+    """
+    key_names = ', '.join([key_name for key_name, _ in media_keys])
+    replace_in_db(global_db, media_table, key_names, (image, file_id, os.stat(image).st_mtime_ns, file_hash(image)))
+    global_db.commit()
 
 
 #-----------------------------------------------------------------------------------------------------------------------
+def seed_products(products: Iterable[Product]):
+    """
+    массовое добавление продуктов одной транзакцией
+    :param products:    (title, description, price, image) - последовательность или итератор
+    """
+    flush_writes()
+    key_names = ', '.join([key_name for key_name, _ in products_keys][1:])
+    with global_db:
+        insert_many_to_db(global_db, products_table, key_names, products)
+
+
+def seed_users(users: Iterable[tuple[str, str, int]]):
+    """
+    массовое добавление пользователей одной транзакцией, баланс - 1000
+    :param users:       (username, email, age) - последовательность или итератор
+    """
+    flush_writes()
+    key_names = ', '.join([key_name for key_name, _ in users_keys][1:])
+    with global_db:
+        insert_many_to_db(global_db, users_table, key_names, ((*user, 1000, None) for user in users))
+
+
+def export_records(table: str, chunk_size: int = 10_000) -> tuple[list[str], Iterator[tuple]]:
+    """
+    :param table:   products_table или users_table
+    :return:        имена столбцов и итератор всех записей таблицы, включая id
+    """
+    key_names = [key_name for key_name, _ in table_keys[table]]
+    flush_writes()
+    return key_names, iter_records_from_db(db_pool.reader(), table, fields=', '.join(key_names), chunk_size=chunk_size)
+
+
+def import_records(table: str, key_names: list[str], records: Iterable[tuple], conflict: str = '') -> int:
+    """
+    массовое добавление записей одной транзакцией через executemany
+    :param table:       products_table или users_table
+    :param key_names:   столбцы таблицы в порядке значений records
+    :param records:     последовательность или итератор кортежей, читается по мере вставки
+    :param conflict:    поведение при нарушении ограничений, например 'OR IGNORE'
+    :return:            число добавленных записей
+    """
+    unknown = set(key_names) - {key_name for key_name, _ in table_keys[table]}
+    if unknown:
+        raise ValueError(f'{table} has no columns {", ".join(sorted(unknown))}')
+
+    flush_writes()
+    with global_db:
+        count = insert_many_to_db(global_db, table, ', '.join(key_names), records, conflict)
+    return count
+
+
 def fill_products_table(count: int):
-    for i in range(1, count+1):
-        add_product(f"Продукт{i}", f"описание {i}", 100 * i, f'img{i}.jpg')
+    seed_products((f"Продукт{i}", f"описание {i}", 100 * i, images.prepare_image(f'img{i}.jpg'))
+                  for i in range(1, count+1))
 
 
 def fill_users_table(count: int):
-    for i in range(1, count+1):
-        add_user(f'User{chr(64+i)}', f'user{i}@gmail.com', 20+i)
+    seed_users((f'User{chr(64+i)}', f'user{i}@gmail.com', 20+i) for i in range(1, count+1))
 
 
 if __name__ == '__main__':
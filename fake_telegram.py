@@ -0,0 +1,279 @@
+"""
+локальная замена Telegram для проверки бота без сети
+
+Сервер Bot API: принимает запросы бота по адресу /bot<token>/<метод> и отвечает правдоподобными результатами.
+    python fake_telegram.py serve [--port 8081]
+    python module_14_5.py --api-server http://localhost:8081 --webhook http://localhost:8080
+
+Нагрузка на webhook бота: отправляет обновления так, как это делал бы Telegram.
+    python fake_telegram.py load http://localhost:8080/webhook --secret <secret> [--updates 1000] [--concurrency 50]
+
+Лимиты Telegram на отправку сообщений (ответ 429 с retry_after): --chat-rate 1 --global-rate 30
+Число вызовов каждого метода: GET /stats
+"""
+import json
+import math
+import time
+import asyncio
+import argparse
+from collections import Counter
+
+from aiohttp import web, ClientSession
+
+from send_scheduler import TokenBucket, message_cost, limited_methods
+from supervisor import update_chat_id
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# ответы Bot API
+
+def fake_message(chat_id: int, message_id: int = 1, text: str = None, photo_id: str = None) -> dict:
+    message = {
+        'message_id': message_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'User{chat_id}'},
+    }
+    if text is not None:
+        message['text'] = text
+    if photo_id is not None:
+        message['photo'] = [{'file_id': photo_id, 'file_unique_id': photo_id, 'width': 320, 'height': 320}]
+    return message
+
+
+def fake_update(update_id: int, chat_id: int, text: str = None, callback_data: str = None) -> dict:
+    """
+    :return: обновление с текстовым сообщением или, если задан callback_data, с нажатием inline-кнопки
+    """
+    if callback_data is None:
+        return {'update_id': update_id, 'message': fake_message(chat_id, update_id, text=text)}
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id),
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'User{chat_id}'},
+        'chat_instance': str(chat_id),
+        'message': fake_message(chat_id, update_id),
+        'data': callback_data,
+    }}
+
+
+class TooManyRequests(Exception):
+    """
+    ответ 429: превышен лимит отправки сообщений
+    """
+    def __init__(self, retry_after: int):
+        super().__init__(f'Too Many Requests: retry after {retry_after}')
+        self.retry_after = retry_after
+
+    def response(self) -> dict:
+        return {'ok': False, 'error_code': 429, 'description': str(self),
+                'parameters': {'retry_after': self.retry_after}}
+
+
+class FakeBotAPI:
+    """
+    результаты методов Bot API и счётчик вызовов
+    """
+    def __init__(self, chat_rate: float = None, global_rate: float = None, chat_burst: float = 3,
+                 global_burst: float = 30):
+        """
+        :param chat_rate:   лимит сообщений в секунду в один чат, None - без лимита
+        :param global_rate: лимит сообщений в секунду во все чаты, None - без лимита
+        """
+        self.calls = Counter()
+        self.message_id = 0
+        self.chat_limit = (chat_rate, chat_burst) if chat_rate else None
+        self.global_bucket = TokenBucket(global_rate, global_burst) if global_rate else None
+        self.chat_buckets: dict[int, TokenBucket] = {}
+
+    def check_limits(self, method: str, data: dict, chat_id: int):
+        """
+        :raise TooManyRequests: если сообщение превышает лимит чата или общий лимит
+        """
+        buckets = []
+        if self.chat_limit is not None:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(*self.chat_limit)
+            buckets.append(bucket)
+        if self.global_bucket is not None:
+            buckets.append(self.global_bucket)
+
+        now = time.monotonic()
+        ready_at = max([bucket.ready_at(now) for bucket in buckets], default=now)
+        if ready_at > now:
+            self.calls['429'] += 1
+            self.calls[f'429 {method}'] += 1
+            raise TooManyRequests(math.ceil(ready_at - now))
+        for bucket in buckets:
+            bucket.take(now, message_cost(method, data))
+
+    def next_message(self, chat_id: int, **kwargs) -> dict:
+        self.message_id += 1
+        return fake_message(chat_id, self.message_id, **kwargs)
+
+    def result(self, method: str, data: dict):
+        """
+        :param method:  метод Bot API, например sendMessage
+        :param data:    параметры запроса
+        """
+        chat_id = int(data.get('chat_id', 0) or 0)
+        if method in limited_methods:
+            self.check_limits(method, data, chat_id)
+        self.calls[method] += 1
+
+        if method == 'sendPhoto':
+            return self.next_message(chat_id, photo_id=f'photo{self.message_id}')
+        if method == 'sendMediaGroup':
+            media = data['media']
+            if isinstance(media, str):
+                media = json.loads(media)
+            return [self.next_message(chat_id, photo_id=f'photo{self.message_id}') for _ in media]
+        if method == 'sendMessage':
+            return self.next_message(chat_id, text=data.get('text'))
+        if method == 'getMe':
+            return {'id': 123456789, 'is_bot': True, 'first_name': 'Bot', 'username': 'fake_bot'}
+        if method == 'getUpdates':
+            return []
+        if method == 'getWebhookInfo':
+            return {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        return True
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# сервер Bot API
+
+def make_app(api: FakeBotAPI = None, latency: float = 0.0) -> web.Application:
+    """
+    :param api:     результаты и счётчик вызовов
+    :param latency: задержка ответа на каждый запрос, с
+    """
+    api = api or FakeBotAPI()
+
+    async def handle(request: web.Request) -> web.Response:
+        data = dict(await request.post()) if request.body_exists else {}
+        data.update(request.query)
+        if latency:
+            await asyncio.sleep(latency)
+        try:
+            return web.json_response({'ok': True, 'result': api.result(request.match_info['method'], data)})
+        except TooManyRequests as e:
+            return web.json_response(e.response(), status=429)
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response(dict(api.calls))
+
+    app = web.Application(client_max_size=50 * 2**20)
+    app['api'] = api
+    app.router.add_get('/stats', stats)
+    app.router.add_route('*', '/bot{token}/{method}', handle)
+    return app
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# нагрузка на webhook
+
+async def load_webhook(url: str, secret: str, updates: list[dict], concurrency: int) -> dict:
+    """
+    отправляет обновления в webhook бота, не больше concurrency одновременно
+    Как и Telegram, следующее обновление чата отправляется только после ответа на предыдущее: обновления делятся
+    между concurrency отправителями по чату, как в supervisor.py, и каждый отправляет свои по порядку.
+    :return: статистика: число обновлений, время, ответы прямо в теле webhook-ответа
+    """
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    shards = [[] for _ in range(concurrency)]
+    for update in updates:
+        shards[hash(update_chat_id(update)) % concurrency].append(update)
+    stats = Counter()
+
+    async def worker(session: ClientSession, shard: list[dict]):
+        for update in shard:
+            async with session.post(url, json=update, headers=headers) as response:
+                stats[f'http {response.status}'] += 1
+                if response.content_type == 'application/json':
+                    stats['inline replies'] += 1
+
+    start = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*[worker(session, shard) for shard in shards])
+    seconds = time.perf_counter() - start
+    return {'updates': len(updates), 'seconds': seconds, 'updates/s': len(updates) / seconds, **stats}
+
+
+def scripted_updates(count: int, chats: int) -> list[dict]:
+    """
+    :return: count обновлений: чаты по очереди проходят /start и расчёт калорий
+    """
+    script = ['/start', 'Рассчитать', None, '30', '180', '80']     # None - кнопка "Рассчитать норму калорий"
+    updates = []
+    for update_id in range(1, count + 1):
+        chat_id = update_id % chats + 1
+        step = script[(update_id // chats) % len(script)]
+        if step is None:
+            updates.append(fake_update(update_id, chat_id, callback_data='calories'))
+        else:
+            updates.append(fake_update(update_id, chat_id, text=step))
+    return updates
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# разговоры
+
+def letters(number: int) -> str:
+    """ число латинскими буквами: имя пользователя для регистрации """
+    return ''.join(chr(ord('a') + int(digit)) for digit in str(number))
+
+
+# шаги разговоров: текст сообщения или (данные inline-кнопки,); {name} - имя пользователя чата
+conversations = {
+    'calories':     ['/start', 'Рассчитать', ('calories',), '30', '180', '80'],
+    'registration': ['/start', 'Регистрация', 'user{name}', 'user{name}@example.com', '30'],
+    'buying':       ['/start', 'Купить', ('product_buying 1',)],
+}
+
+
+def conversation_updates(kind: str, chat_id: int, first_update_id: int) -> list[dict]:
+    """
+    :param kind:            разговор из conversations
+    :param chat_id:         чат пользователя
+    :param first_update_id: update_id первого обновления
+    :return:                обновления разговора по порядку
+    """
+    updates = []
+    for update_id, step in enumerate(conversations[kind], first_update_id):
+        if isinstance(step, tuple):
+            updates.append(fake_update(update_id, chat_id, callback_data=step[0]))
+        else:
+            updates.append(fake_update(update_id, chat_id, text=step.format(name=letters(chat_id))))
+    return updates
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help='сервер Bot API')
+    serve.add_argument('--host', default='localhost')
+    serve.add_argument('--port', type=int, default=8081)
+    serve.add_argument('--latency', type=float, default=0.0, help='задержка ответа, с')
+    serve.add_argument('--chat-rate', type=float, default=None, help='лимит сообщений в секунду в один чат')
+    serve.add_argument('--global-rate', type=float, default=None, help='лимит сообщений в секунду во все чаты')
+
+    load = commands.add_parser('load', help='нагрузка на webhook бота')
+    load.add_argument('url', help='адрес webhook бота')
+    load.add_argument('--secret', default=None, help='секрет webhook (X-Telegram-Bot-Api-Secret-Token)')
+    load.add_argument('--updates', type=int, default=1000)
+    load.add_argument('--chats', type=int, default=100)
+    load.add_argument('--concurrency', type=int, default=50)
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        api = FakeBotAPI(chat_rate=args.chat_rate, global_rate=args.global_rate)
+        web.run_app(make_app(api, latency=args.latency), host=args.host, port=args.port)
+    else:
+        updates = scripted_updates(args.updates, args.chats)
+        print(asyncio.run(load_webhook(args.url, args.secret, updates, args.concurrency)))
+
+
+if __name__ == '__main__':
+    main()
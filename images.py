@@ -0,0 +1,218 @@
+#-----------------------------------------------------------------------------------------------------------------------
+# подготовка картинок продуктов
+#
+# При добавлении продукта картинка:
+#   - уменьшается до photo_size по большей стороне - больше Telegram всё равно не показывает, а загрузка дольше;
+#   - пережимается в JPEG без метаданных (EXIF, XMP, ICC, ...), поворот из EXIF применяется заранее;
+#   - сохраняется в media_dir под именем из хэша содержимого и настроек вместе с уменьшенной копией thumbnail_size.
+# Одинаковые картинки хранятся один раз, повторная подготовка той же картинки только читает её и считает хэш.
+# Файлы в media_dir не меняются, поэтому их содержимое можно один раз прочитать в память (preload)
+# и отправлять без чтения файла на каждый запрос. Картинки продуктов, добавленных до появления images.py, готовятся
+# при загрузке каталога (prepared_name).
+#
+# Без Pillow картинка копируется в media_dir как есть, без уменьшения и уменьшенной копии.
+
+import io
+import os
+import hashlib
+import tempfile
+import threading
+from functools import lru_cache
+
+
+media_dir = 'media'
+photo_size = 1280           # наибольшая сторона картинки, px
+thumbnail_size = 320        # наибольшая сторона уменьшенной копии, px
+jpeg_quality = 85
+preload_budget = 64 * 2**20     # сколько байт картинок держать в памяти
+
+process_version = 2         # меняется вместе с process: картинки, подготовленные прежде, готовятся заново
+
+exif_orientation = 0x0112
+metadata_keys = ('exif', 'xmp', 'icc_profile', 'photoshop', 'comment')     # что Pillow читает из JPEG кроме картинки
+
+
+@lru_cache(maxsize=None)
+def pillow():
+    """
+    :return: модуль PIL.Image или None, если Pillow не установлен
+    """
+    # импорт при первой подготовке картинки: запуску бота, который только отправляет готовые картинки, Pillow не нужен
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+
+def settings_key() -> bytes:
+    # при изменении настроек картинки готовятся заново под новыми именами
+    return f'{process_version}:{photo_size}:{thumbnail_size}:{jpeg_quality}:{pillow() is not None}'.encode()
+
+
+def thumbnail_name(image: str) -> str:
+    """
+    :param image:   имя подготовленной картинки
+    :return:        имя её уменьшенной копии
+    """
+    name, extension = os.path.splitext(image)
+    return f'{name}_thumb{extension}'
+
+
+def write_once(filename: str, data: bytes):
+    """
+    записывает файл атомарно: другой процесс бота увидит либо весь файл, либо никакого
+    """
+    if os.path.exists(filename):
+        return
+    fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.chmod(temp_name, 0o644)      # mkstemp создаёт файл, доступный только владельцу
+        os.replace(temp_name, filename)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
+
+
+def has_metadata(data: bytes) -> bool:
+    """
+    :return: True, если в JPEG есть что-то из metadata_keys
+    """
+    with pillow().open(io.BytesIO(data)) as image:
+        return any(key in image.info for key in metadata_keys)
+
+
+def encode_jpeg(image, size: int) -> bytes:
+    """
+    :return: JPEG картинки, уменьшенной до size по большей стороне, без метаданных
+    """
+    image = image.copy()
+    image.info.clear()      # Pillow записывает в JPEG комментарий из info, даже если его не передали в save
+    image.thumbnail((size, size), pillow().LANCZOS)
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=jpeg_quality, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def process(source: bytes) -> tuple[bytes, bytes]:
+    """
+    :param source:  содержимое исходной картинки
+    :return:        (картинка, уменьшенная копия) в JPEG
+    """
+    from PIL import ImageOps
+
+    original = pillow().open(io.BytesIO(source))
+    rotated = original.getexif().get(exif_orientation, 1) != 1
+    image = ImageOps.exif_transpose(original)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    photo = encode_jpeg(image, photo_size)
+
+    if original.format == 'JPEG' and not rotated and max(original.size) <= photo_size:
+        # маленький JPEG без поворота: сохраняем прежнее сжатие, только убираем метаданные -
+        # повторное сжатие часто делает такие файлы больше
+        original.info.clear()
+        output = io.BytesIO()
+        original.save(output, 'JPEG', quality='keep', optimize=True, progressive=True)
+        # исходный файл подходит, только если в нём уже нет метаданных
+        candidates = [output.getvalue(), source]
+        photo = min([photo] + [candidate for candidate in candidates if not has_metadata(candidate)], key=len)
+    return photo, encode_jpeg(image, thumbnail_size)
+
+
+def prepare_image(filename: str) -> str:
+    """
+    готовит картинку к отправке в Telegram
+    :param filename:    исходная картинка
+    :return:            имя подготовленной картинки в media_dir; исходное имя, если файла нет или он не картинка
+    """
+    try:
+        with open(filename, 'rb') as file:
+            source = file.read()
+    except OSError:
+        return filename
+
+    digest = hashlib.sha1(settings_key() + source).hexdigest()
+    image = os.path.join(media_dir, f'{digest}.jpg')
+    if os.path.exists(image):
+        return image
+
+    if pillow() is None:
+        photo, thumbnail = source, None
+    else:
+        try:
+            photo, thumbnail = process(source)
+        except (OSError, ValueError, pillow().DecompressionBombError):
+            return filename
+
+    os.makedirs(media_dir, exist_ok=True)
+    if thumbnail is not None:
+        write_once(thumbnail_name(image), thumbnail)
+    write_once(image, photo)        # последней: по ней проверяется, что картинка уже готова
+    return image
+
+
+prepared_names: dict[tuple[str, int, int], str] = {}     # (файл, mtime, размер) -> prepare_image(файл)
+
+
+def prepared_name(filename: str) -> str:
+    """
+    :param filename:    картинка продукта: подготовленная или, в записях, добавленных до images.py, исходная
+    :return:            имя подготовленной картинки. Исходная картинка готовится при первом обращении
+                        и после изменения файла, иначе берётся запомненное имя без чтения файла
+    """
+    if os.path.dirname(filename) == media_dir:
+        return filename
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return filename
+    key = (filename, stat.st_mtime_ns, stat.st_size)
+    image = prepared_names.get(key)
+    if image is None:
+        image = prepared_names[key] = prepare_image(filename)
+    return image
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# содержимое картинок в памяти
+
+preloaded: dict[str, bytes] = {}
+preloaded_size = 0
+preload_lock = threading.Lock()     # каталог загружается в потоках чтения базы данных
+
+
+def load(filename: str) -> bytes | None:
+    """
+    :return: содержимое картинки, None - если файла нет. Картинки из media_dir остаются в памяти,
+             пока их общий размер не больше preload_budget
+    """
+    global preloaded_size
+    data = preloaded.get(filename)
+    if data is not None:
+        return data
+    try:
+        with open(filename, 'rb') as file:
+            data = file.read()
+    except OSError:
+        return None
+    # файлы вне media_dir могут измениться, их не запоминаем
+    if os.path.dirname(filename) == media_dir:
+        with preload_lock:
+            if filename not in preloaded and preloaded_size + len(data) <= preload_budget:
+                preloaded[filename] = data
+                preloaded_size += len(data)
+    return data
+
+
+if __name__ == '__main__':
+    import sys
+
+    for name in sys.argv[1:]:
+        prepared = prepare_image(name)
+        if prepared == name:
+            print(f'{name}: not an image')
+        else:
+            print(f'{name} ({os.path.getsize(name)} bytes) -> {prepared} ({os.path.getsize(prepared)} bytes)')
@@ -0,0 +1,350 @@
+#-----------------------------------------------------------------------------------------------------------------------
+# метрики бота в текстовом формате Prometheus
+#
+# Что измеряется:
+#   bot_update_seconds      - обработка обновления целиком, включая фильтры и middleware
+#   bot_handler_seconds     - время обработчика (get_buying_list, set_username, send_calories, ...)
+#   bot_query_seconds       - запросы к базе данных через функции crud_functions, по операции и таблице
+#   bot_api_seconds         - запросы к Bot API, по методу; bot_api_errors_total - неудачные запросы
+#   bot_fsm_states          - число разговоров в каждом состоянии FSM, считается при чтении /metrics
+#   bot_fsm_conversations, bot_fsm_bytes - число живых разговоров и размер их данных, всего и в памяти (where)
+#
+# Число запросов в секунду - rate(..._count) в Prometheus. Измерение - два вызова perf_counter и одно
+# прибавление к гистограмме под блокировкой, поэтому метрики можно не выключать.
+#
+# Профилировщик: GET /profile?seconds=10 на сервере метрик в течение seconds секунд снимает стеки всех потоков
+# и возвращает их в свёрнутом формате (collapsed stacks) для flamegraph.pl или speedscope. Пока профилировщик
+# не запущен, он ничего не стоит.
+
+import sys
+import json
+import time
+import asyncio
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+
+# верхние границы интервалов гистограмм, с
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = tuple[str, ...]
+
+
+class Histogram:
+    """
+    гистограмма одного набора меток
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count', 'lock')
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)      # последний интервал - больше всех границ
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()                # запросы к базе данных измеряются в потоке базы данных
+
+    def observe(self, value: float):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Metric:
+    """
+    метрика с метками: значение для каждого набора меток создаётся при первом обращении
+    """
+    kind = ''
+
+    def __init__(self, name: str, help: str, label_names: Labels = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.values: dict[Labels, object] = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values: str):
+        value = self.values.get(values)
+        if value is None:
+            with self.lock:
+                value = self.values.setdefault(values, self.new_value())
+        return value
+
+    def new_value(self):
+        raise NotImplementedError
+
+    def samples(self) -> list[tuple[str, Labels, tuple, float]]:
+        """
+        :return: строки метрики: (суффикс имени, значения меток, дополнительная метка, значение)
+        """
+        raise NotImplementedError
+
+
+class HistogramMetric(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, label_names: Labels = (), buckets: tuple[float, ...] = default_buckets):
+        super().__init__(name, help, label_names)
+        self.buckets = buckets
+
+    def new_value(self) -> Histogram:
+        return Histogram(self.buckets)
+
+    def observe(self, *labels: str, seconds: float):
+        self.labels(*labels).observe(seconds)
+
+    def samples(self):
+        samples = []
+        for labels, histogram in list(self.values.items()):
+            with histogram.lock:
+                counts, total, count = list(histogram.counts), histogram.sum, histogram.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', labels, ('le', format_value(bound)), cumulative))
+            samples.append(('_sum', labels, (), total))
+            samples.append(('_count', labels, (), count))
+        return samples
+
+
+class CounterMetric(Metric):
+    kind = 'counter'
+
+    def new_value(self) -> list[int]:
+        return [0]
+
+    def inc(self, *labels: str):
+        value = self.labels(*labels)
+        with self.lock:
+            value[0] += 1
+
+    def samples(self):
+        return [('', labels, (), value[0]) for labels, value in list(self.values.items())]
+
+
+update_seconds = HistogramMetric('bot_update_seconds', 'Обработка обновления целиком')
+handler_seconds = HistogramMetric('bot_handler_seconds', 'Время обработчика', ('event', 'handler'))
+query_seconds = HistogramMetric('bot_query_seconds', 'Время запроса к базе данных', ('operation', 'table'))
+api_seconds = HistogramMetric('bot_api_seconds', 'Время запроса к Bot API', ('method',))
+api_errors = CounterMetric('bot_api_errors_total', 'Неудачные запросы к Bot API', ('method', 'error'))
+
+registry: list[Metric] = [update_seconds, handler_seconds, query_seconds, api_seconds, api_errors]
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# источники измерений
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    измеряет обработку каждого обновления и время выбранного для него обработчика
+    """
+    async def trigger(self, action: str, args):
+        # вместо отдельных on_process_message, on_process_callback_query, ... - одна функция на все виды событий
+        data = args[-1]
+        if action == 'pre_process_update':
+            data['metrics_start'] = time.perf_counter()
+        elif action == 'post_process_update':
+            start = data.pop('metrics_start', None)
+            if start is not None:
+                update_seconds.observe(seconds=time.perf_counter() - start)
+        elif action == 'process_update':
+            pass                            # обработчик - сам Dispatcher.process_update
+        elif action.startswith('process_'):
+            # вызывается после фильтров, перед самим обработчиком, который уже записан в current_handler
+            data['metrics_handler'] = (current_handler.get(), time.perf_counter())
+        elif action.startswith('post_process_'):
+            handler, start = data.pop('metrics_handler', (None, None))
+            if handler is not None:
+                event = action[len('post_process_'):]
+                handler_seconds.observe(event, handler.__name__, seconds=time.perf_counter() - start)
+
+
+def observe_query(operation: str, table: str, seconds: float):
+    """
+    функция для crud_functions.query_hooks
+    """
+    query_seconds.observe(operation, table, seconds=seconds)
+
+
+def instrument_bot(bot: Bot):
+    """
+    измеряет каждый запрос bot к Bot API
+    """
+    request = bot.request
+
+    async def timed_request(method: str, data=None, files=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await request(method, data, files, **kwargs)
+        except Exception as e:
+            api_errors.inc(method, type(e).__name__)
+            raise
+        finally:
+            api_seconds.observe(method, seconds=time.perf_counter() - start)
+
+    bot.request = timed_request
+
+
+async def fsm_state_counts(storage) -> dict[str, int]:
+    """
+    :return: {состояние: число разговоров в нём}
+    """
+    if hasattr(storage, 'state_counts'):
+        return await storage.state_counts()
+    # MemoryStorage: {chat: {user: {'state': ..., 'data': ..., 'bucket': ...}}}
+    counts = Counter()
+    for users in getattr(storage, 'data', {}).values():
+        for record in users.values():
+            if record.get('state') is not None:
+                counts[record['state']] += 1
+    return dict(counts)
+
+
+async def fsm_usage(storage) -> dict[str, int]:
+    """
+    :return: {'conversations', 'bytes', 'cached_conversations', 'cached_bytes'}, см. SQLiteStorage.stats
+    """
+    if hasattr(storage, 'stats'):
+        return await storage.stats()
+    # MemoryStorage хранит все разговоры в памяти
+    conversations = size = 0
+    for users in getattr(storage, 'data', {}).values():
+        for record in users.values():
+            conversations += 1
+            size += (len(record.get('state') or '') + len(json.dumps(record.get('data', {}), default=str))
+                     + len(json.dumps(record.get('bucket', {}), default=str)))
+    return {'conversations': conversations, 'bytes': size,
+            'cached_conversations': conversations, 'cached_bytes': size}
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# текстовый формат Prometheus
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_labels(names: Labels, values: Labels, extra: tuple = ()) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def render(fsm_states: dict[str, int] = None, fsm_stats: dict[str, int] = None) -> str:
+    """
+    :param fsm_states:  число разговоров в каждом состоянии FSM
+    :param fsm_stats:   число разговоров и размер их данных, см. fsm_usage
+    :return:            все метрики в текстовом формате Prometheus
+    """
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for suffix, labels, extra, value in metric.samples():
+            lines.append(f'{metric.name}{suffix}{format_labels(metric.label_names, labels, extra)} '
+                         f'{format_value(value)}')
+
+    if fsm_states is not None:
+        lines.append('# HELP bot_fsm_states Число разговоров в состоянии FSM')
+        lines.append('# TYPE bot_fsm_states gauge')
+        for state, count in sorted(fsm_states.items()):
+            lines.append(f'bot_fsm_states{format_labels(("state",), (state,))} {count}')
+
+    if fsm_stats is not None:
+        for name, help, key in (('bot_fsm_conversations', 'Число живых разговоров FSM', 'conversations'),
+                                ('bot_fsm_bytes', 'Размер данных разговоров FSM в JSON, байт', 'bytes')):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name}{format_labels(("where",), ("total",))} {fsm_stats[key]}')
+            lines.append(f'{name}{format_labels(("where",), ("memory",))} {fsm_stats["cached_" + key]}')
+    return '\n'.join(lines) + '\n'
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# профилировщик
+
+def frame_stack(frame) -> list[str]:
+    """
+    :return: стек от внешней функции к внутренней, каждая функция - "файл:функция"
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f'{code.co_filename.rsplit("/", 1)[-1]}:{code.co_name}')
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> Counter:
+    """
+    каждые interval секунд запоминает стеки всех потоков, кроме текущего
+    :return: {"поток;файл:функция;...": число попаданий}
+    """
+    me = threading.get_ident()
+    stacks = Counter()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident != me:
+                stacks[';'.join([names.get(ident, str(ident))] + frame_stack(frame))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# сервер метрик
+
+def make_app(dp: Dispatcher) -> web.Application:
+    """
+    :param dp:  диспетчер бота, из его хранилища считаются состояния FSM
+    """
+    profiling = asyncio.Lock()
+
+    async def get_metrics(request: web.Request) -> web.Response:
+        text = render(await fsm_state_counts(dp.storage), await fsm_usage(dp.storage))
+        return web.Response(text=text, content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def get_profile(request: web.Request) -> web.Response:
+        seconds = min(float(request.query.get('seconds', 10)), 60.0)
+        interval = max(float(request.query.get('interval', 0.005)), 0.001)
+        if profiling.locked():
+            raise web.HTTPConflict(text='profiler is already running')
+        async with profiling:
+            stacks = await asyncio.get_running_loop().run_in_executor(None, sample_stacks, seconds, interval)
+        return web.Response(text=''.join(f'{stack} {count}\n' for stack, count in stacks.most_common()))
+
+    app = web.Application()
+    app.router.add_get('/metrics', get_metrics)
+    app.router.add_get('/profile', get_profile)
+    return app
+
+
+async def start_server(dp: Dispatcher, host: str, port: int) -> web.AppRunner:
+    """
+    запускает сервер метрик в текущем цикле событий
+    :return: runner, для остановки - await runner.cleanup()
+    """
+    runner = web.AppRunner(make_app(dp))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
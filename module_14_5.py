@@ -1,18 +1,44 @@
 #from email import message_from_binary_file
 
 from aiogram import Bot, Dispatcher, executor
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.dispatcher.webhook import WebhookRequestHandler, SendMessage
 from aiogram.types.message import Message
 from aiogram.types.callback_query import CallbackQuery
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.contrib.fsm_storage.memory import MemoryStorage, BaseStorage
+from aiogram.types import MediaGroup, InputFile
+from aiogram.contrib.fsm_storage.memory import BaseStorage
 from aiogram.dispatcher.filters.state import State, StatesGroup
-#import asyncio
+import io
+import os
+import asyncio
+import secrets
+import argparse
 
+from aiohttp import web
 from string import ascii_letters
 
-from crud_functions import initiate_db, get_all_products, close_db, is_included, add_user
-products: list
+from crud_functions import initiate_db, close_db
+from async_crud_functions import is_included, register_user, is_registered, buy_product
+from async_crud_functions import get_media_file_id, set_media_file_id
+from async_crud_functions import flush_writes_periodically
+import async_crud_functions
+from catalog import Catalog
+from calories import calc_calories
+from sqlite_storage import SQLiteStorage
+from send_scheduler import SendScheduler, bulk_sends
+import crud_functions
+import images
+import metrics
+import routing
+
+# способ вывода каталога:
+#   'photos' - отдельное сообщение на каждый продукт
+#   'album'  - альбомами sendMediaGroup, при большом каталоге - постранично
+catalog_mode = 'album'
+catalog_page_size = 10      # больше 10 картинок в одном альбоме Telegram не принимает
+catalog = Catalog(catalog_page_size)
 
 
 try:
@@ -22,22 +48,53 @@ except ImportError:
     print("Place token in credentials.py")
     exit(1)
 
+# секрет webhook, нужен только в режиме webhook. Все экземпляры бота за одним адресом должны использовать один
+# и тот же секрет: каждый из них передаёт его Telegram в setWebhook, и действует последний переданный
+try:
+    from credentials import webhook_secret
+except ImportError:
+    webhook_secret = None
 
-def calc_calories(gender: str, age: float, growth: float, weight: float):
-    """
-    формула Миффлина - Сан Жеора для подсчёта нормы калорий для женщин или мужчин
-    :param gender: пол, 'M' или 'F'
-    :param age: вес в кг
-    :param growth: рост в см
-    :param weight: возраст в г
-    :return: норма калорий
-    """
-    # (10 х вес в кг) + (6, 25 х рост в см) – (5 х возраст в г) + 5(M) или -161(F).
-    return (10.0 * weight) + (6.25 * growth) - (5.0 * age) + 5.0 if gender == 'M' else -161.0
+# режим webhook: python module_14_5.py --webhook https://<внешний адрес бота>
+webhook_host = '0.0.0.0'
+webhook_port = 8080
+webhook_path = '/webhook'
+webhook_mode = False
+
+# метрики Prometheus: http://127.0.0.1:9100/metrics, 0 - без сервера метрик (измерения всё равно идут)
+metrics_host = '127.0.0.1'
+metrics_port = 9100
+
+
+fsm_database_filename = 'fsm.db'     # состояния разговоров, отдельно от database.db
+fsm_ttl = 24 * 60 * 60              # разговор без действий дольше fsm_ttl секунд считается брошенным и удаляется
+fsm_max_bytes = 256 * 2**20         # сверх этого размера данных разговоров удаляются самые давние
 
 
 bot = Bot(token=token)
-dp = Dispatcher(bot, storage=MemoryStorage())
+dp = Dispatcher(bot, storage=SQLiteStorage(fsm_database_filename, ttl=fsm_ttl, max_bytes=fsm_max_bytes))
+routing.install(dp)         # обработчики выбираются по состоянию и тексту, а не перебором всех фильтров
+
+dp.middleware.setup(metrics.MetricsMiddleware())
+metrics.instrument_bot(bot)
+crud_functions.query_hooks.append(metrics.observe_query)
+
+# все сообщения бота уходят через планировщик с лимитами Telegram, метрики bot_api_seconds - без ожидания в очереди
+send_scheduler = SendScheduler()
+send_scheduler.install(bot)
+
+
+async def reply(message: Message, text: str, **kwargs) -> SendMessage | None:
+    """
+    отвечает на сообщение текстом
+    В режиме webhook ответ уходит прямо в теле ответа на запрос Telegram, без отдельного запроса к Bot API,
+    поэтому обработчик должен вернуть результат reply, и это должен быть его последний ответ. Лимиты Telegram
+    касаются и такого ответа: он ждёт своей очереди в send_scheduler, как и остальные сообщения.
+    """
+    if webhook_mode:
+        await send_scheduler.reserve(message.chat.id)
+        return SendMessage(message.chat.id, text, **kwargs)
+    await message.answer(text, **kwargs)
 
 
 #-----------------------------------------------------------------------------------------------------------------------
@@ -58,28 +115,113 @@ async def start_message(message: Message):
         # Кнопки главного меню дополните кнопкой "Регистрация".
         KeyboardButton(text="Регистрация")
     )
-    await message.answer('Привет! Я бот помогающий твоему здоровью.', reply_markup=kb)
+    return await reply(message, 'Привет! Я бот помогающий твоему здоровью.', reply_markup=kb)
+
+
+async def refresh_catalog():
+    """ перечитывает каталог, если таблица Products изменилась """
+    version, products = await async_crud_functions.get_products_if_changed(catalog.version)
+    if products is not None:
+        # картинки готовятся и читаются в потоке чтения: чтение файлов в цикле событий остановило бы все чаты
+        products = await asyncio.get_running_loop().run_in_executor(async_crud_functions.read_executor,
+                                                                    Catalog.prepare, products)
+        catalog.load(version, products)
+
+
+def photo_file(image: str) -> InputFile | None:
+    """ :return: картинка для загрузки из памяти, None - если файла нет """
+    data = images.load(image)
+    if data is None:
+        return None
+    return InputFile(io.BytesIO(data), filename=os.path.basename(image))
+
+
+async def send_catalog_photos(message: Message):
+    """ каталог по одному сообщению на продукт """
+    for product in catalog.products:
+        file_id = await get_media_file_id(product.image)
+        if file_id:
+            await message.answer_photo(file_id, product.caption)   # уже загруженная картинка
+            continue
+        photo = photo_file(product.image)
+        if photo is None:
+            await message.answer(product.caption)                  # без картинки
+            continue
+        sent = await message.answer_photo(photo, product.caption)  # с картинкой
+        await set_media_file_id(product.image, sent.photo[-1].file_id)  # в следующий раз без повторной загрузки
+
+    return await reply(message, 'Выберите продукт для покупки:', reply_markup=catalog.keyboard())
+
+
+async def send_catalog_page(message: Message, page: int):
+    """ страница каталога одним альбомом """
+    media = MediaGroup()
+    uploads = []        # имя файла для каждой загружаемой картинки альбома, None - если file_id уже известен
+    texts = []          # продукты без картинок
+    for product in catalog.page(page):
+        file_id = await get_media_file_id(product.image)
+        if file_id:
+            media.attach_photo(file_id, product.caption)
+            uploads.append(None)
+            continue
+        photo = photo_file(product.image)
+        if photo is None:
+            texts.append(product.caption)
+        else:
+            media.attach_photo(photo, product.caption)
+            uploads.append(product.image)
+
+    if len(media.media) == 1:
+        # альбом из одной картинки Telegram не принимает
+        photo = media.media[0]
+        sent = [await message.answer_photo(photo.file or photo.media, photo.caption)]
+    elif media.media:
+        sent = await message.answer_media_group(media)
+    else:
+        sent = []
+
+    for sent_message, img in zip(sent, uploads):
+        if img:
+            await set_media_file_id(img, sent_message.photo[-1].file_id)
+    if texts:
+        await message.answer('\n'.join(texts))
+
+    return await reply(message, 'Выберите продукт для покупки:', reply_markup=catalog.keyboard(page))
 
 
 @dp.message_handler(text='Купить')
 async def get_buying_list(message: Message):
-    for name, description, price, img in products:
-        text = f'Название: {name} | Описание: {description} | Цена: {price}'
-        try:
-            with open(img, 'rb') as file:
-                await message.answer_photo(file, text)  # с картинкой, если есть
-        except IOError:
-            await message.answer(text)                  # или без картинки
+    await refresh_catalog()
+    with bulk_sends():      # каталог уступает очередь ответам в других чатах
+        if catalog_mode == 'photos':
+            return await send_catalog_photos(message)
+        return await send_catalog_page(message, 0)
 
-    kb = InlineKeyboardMarkup()
-    kb.add(*[InlineKeyboardButton(text=name, callback_data=f"product_buying {name}") for name, _, _, _ in products])
-    await message.answer('Выберите продукт для покупки:', reply_markup=kb)
 
+@dp.callback_query_handler(text_startswith='product_page ')
+async def get_buying_page(call: CallbackQuery):
+    page = int(call.data.replace('product_page ', ''))
+    await refresh_catalog()
+    await call.answer()
+    with bulk_sends():
+        return await send_catalog_page(call.message, page)
 
-@dp.callback_query_handler(lambda t: t.data and t.data.startswith('product_buying '))
+
+@dp.callback_query_handler(text_startswith='product_buying ')
 async def send_confirm_message(call: CallbackQuery):
-    product_name = call.data.replace('product_buying ', '')
-    await call.message.answer(f"Вы успешно приобрели {product_name}!")
+    await refresh_catalog()
+    product = catalog.find(call.data.replace('product_buying ', ''))
+    if product is None:
+        return await reply(call.message, "Этого продукта больше нет в каталоге")
+
+    result, balance = await buy_product(call.from_user.id, product.id)
+    if result == crud_functions.purchase_done:
+        return await reply(call.message, f"Вы успешно приобрели {product.title}! Баланс: {balance}")
+    if result == crud_functions.purchase_no_money:
+        return await reply(call.message, f"Недостаточно средств: цена {product.price}, баланс {balance}")
+    if result == crud_functions.purchase_no_user:
+        return await reply(call.message, "Для покупок нужно зарегистрироваться: кнопка \"Регистрация\"")
+    return await reply(call.message, "Этого продукта больше нет в каталоге")
 
 
 @dp.message_handler(text='Рассчитать')
@@ -88,12 +230,12 @@ async def main_menu(message: Message):
     info_button = InlineKeyboardButton(text='Рассчитать норму калорий', callback_data='calories')
     calc_button = InlineKeyboardButton(text='Формулы расчёта', callback_data='formulas')
     kb.row(info_button, calc_button)
-    await message.answer('Выберите опцию:', reply_markup=kb)
+    return await reply(message, 'Выберите опцию:', reply_markup=kb)
 
 
 @dp.callback_query_handler(text='formulas')
 async def get_formulas(call: CallbackQuery):
-    await call.message.answer('''\
+    return await reply(call.message, '''\
 формула Миффлина - Сан Жеора для подсчёта нормы калорий
 для женщин:
 (10 х вес в кг) + (6, 25 х рост в см) – (5 х возраст в г) -161
@@ -104,9 +246,9 @@ async def get_formulas(call: CallbackQuery):
 
 @dp.callback_query_handler(text='calories')
 async def set_age(call: CallbackQuery):
-    await call.message.answer('Введите свой возраст:')
     await call.answer()
     await UserState.age.set()
+    return await reply(call.message, 'Введите свой возраст:')
 
 
 @dp.message_handler(state = UserState.age)
@@ -115,12 +257,11 @@ async def set_growth(message: Message, state: BaseStorage):
         age = float(message.text)
         assert age > 0
     except (ValueError, AssertionError):
-        await message.answer('Возраст должен быть положительным числом!')
-        return
+        return await reply(message, 'Возраст должен быть положительным числом!')
 
     await state.update_data(age=age)
-    await message.answer('Введите свой рост:')
     await UserState.growth.set()
+    return await reply(message, 'Введите свой рост:')
 
 
 @dp.message_handler(state = UserState.growth)
@@ -129,12 +270,11 @@ async def set_weight(message: Message, state: BaseStorage):
         growth = float(message.text)
         assert growth > 0
     except (ValueError, AssertionError):
-        await message.answer('Рост должен быть положительным числом!')
-        return
+        return await reply(message, 'Рост должен быть положительным числом!')
 
     await state.update_data(growth=growth)
-    await message.answer('Введите свой вес:')
     await UserState.weight.set()
+    return await reply(message, 'Введите свой вес:')
 
 
 @dp.message_handler(state = UserState.weight)
@@ -143,15 +283,14 @@ async def send_calories(message: Message, state: BaseStorage):
         weight = float(message.text)
         assert weight > 0
     except (ValueError, AssertionError):
-        await message.answer('Вес должен быть положительным числом!')
-        return
+        return await reply(message, 'Вес должен быть положительным числом!')
 
     await state.update_data(weight=weight)
     data = await state.get_data()
     age, growth, weight = (data[k] for k in ['age', 'growth', 'weight'])
     calories = calc_calories('M', age, growth, weight)
-    await message.answer(f'Ваша норма калорий: {calories}')
     await state.finish()
+    return await reply(message, f'Ваша норма калорий: {calories}')
 
 
 #-----------------------------------------------------------------------------------------------------------------------
@@ -167,10 +306,12 @@ class RegistrationState(StatesGroup):
 
 @dp.message_handler(text='Регистрация')
 async def sign_up(message: Message):
-    # Эта функция должна выводить в Telegram-бот сообщение "Введите имя пользователя (только латинский алфавит):".
-    await message.answer("Введите имя пользователя (только латинский алфавит):")
+    if await is_registered(message.from_user.id):
+        return await reply(message, "Вы уже зарегистрированы")
     # После ожидать ввода имени в атрибут RegistrationState.username при помощи метода set.
     await RegistrationState.username.set()
+    # Эта функция должна выводить в Telegram-бот сообщение "Введите имя пользователя (только латинский алфавит):".
+    return await reply(message, "Введите имя пользователя (только латинский алфавит):")
 
 
 @dp.message_handler(state = RegistrationState.username)
@@ -178,33 +319,31 @@ async def set_username(message: Message, state: BaseStorage):
     username = message.text
 
     if not all(map(lambda c: c in ascii_letters, username)):
-        await message.answer("только латинский алфавит")
-        return
+        return await reply(message, "только латинский алфавит")
 
-    if is_included(username):
+    if await is_included(username):
         # Если пользователь с таким message.text есть в таблице,
         # то выводить "Пользователь существует, введите другое имя"
-        await message.answer("Пользователь существует, введите другое имя")
         # и запрашивать новое состояние для RegistrationState.username.
-        return
+        return await reply(message, "Пользователь существует, введите другое имя")
 
     # Если пользователя message.text ещё нет в таблице,
     # то должны обновляться данные в состоянии username на message.text.
     await state.update_data(username=username)
-    # Далее выводится сообщение "Введите свой email:"
-    await message.answer("Введите свой email:")
     # и принимается новое состояние RegistrationState.email.
     await RegistrationState.email.set()
+    # Далее выводится сообщение "Введите свой email:"
+    return await reply(message, "Введите свой email:")
 
 
 @dp.message_handler(state = RegistrationState.email)
 async def set_email(message: Message, state: BaseStorage):
     # Эта функция должна обновляться данные в состоянии RegistrationState.email на message.text.
     await state.update_data(email=message.text)
-    # Далее выводить сообщение "Введите свой возраст:":
-    await message.answer("Введите свой возраст:")
     # После ожидать ввода возраста в атрибут RegistrationState.age.
     await RegistrationState.age.set()
+    # Далее выводить сообщение "Введите свой возраст:":
+    return await reply(message, "Введите свой возраст:")
 
 
 @dp.message_handler(state = RegistrationState.age)
@@ -213,8 +352,7 @@ async def set_age(message: Message, state: BaseStorage):
         age = float(message.text)
         assert age > 0
     except (ValueError, AssertionError):
-        await message.answer('Возраст должен быть положительным числом!')
-        return
+        return await reply(message, 'Возраст должен быть положительным числом!')
 
     # Эта функция должна обновляться данные в состоянии RegistrationState.age на message.text.
     await state.update_data(age=age)
@@ -222,7 +360,11 @@ async def set_age(message: Message, state: BaseStorage):
     data = await state.get_data()
     username, email, age = (data[k] for k in ['username', 'email', 'age'])
     # и записывать в таблицу Users при помощи ранее написанной crud-функции add_user.
-    add_user(username, email, age)
+    # register_user проверяет занятость имени и добавляет пользователя одним запросом:
+    # пока этот пользователь вводил email и возраст, имя мог занять кто-то другой
+    if not await register_user(username, email, age, message.from_user.id):
+        await RegistrationState.username.set()
+        return await reply(message, "Пользователь с таким именем или email существует, введите другое имя")
     # В конце завершать приём состояний при помощи метода finish().
     await state.finish()
 
@@ -234,15 +376,84 @@ async def all_messages(message: Message):
     обработчик остальных сообщений
     Запускается при любом обращении не описанном ранее.
     """
-    await message.answer('Введите команду /start, чтобы начать общение.')
+    return await reply(message, 'Введите команду /start, чтобы начать общение.')
+
+
+class SecretWebhookRequestHandler(WebhookRequestHandler):
+    """
+    принимает только запросы с секретом webhook_secret, который бот передал Telegram в setWebhook
+    """
+    async def post(self):
+        secret = self.request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not secrets.compare_digest(secret.encode(), webhook_secret.encode()):
+            raise web.HTTPUnauthorized()
+        return await super().post()
+
+
+async def on_startup(dispatcher: Dispatcher):
+    asyncio.create_task(flush_writes_periodically())
+    if metrics_port:
+        await metrics.start_server(dispatcher, metrics_host, metrics_port)
+
+
+def start_webhook(url: str, host: str, port: int, path: str):
+    """
+    :param url:     внешний адрес бота, на который Telegram отправляет обновления
+    :param host:    адрес, на котором слушает сервер
+    :param port:    порт сервера
+    :param path:    путь webhook на сервере
+    """
+    global webhook_mode
+    webhook_mode = True
+
+    async def set_webhook(dispatcher: Dispatcher):
+        await dispatcher.bot.set_webhook(url.rstrip('/') + path, secret_token=webhook_secret)
+
+    webhook = executor.Executor(dp, skip_updates=True)
+    webhook.on_startup(on_startup)
+    webhook.on_startup(set_webhook, polling=False)
+    webhook.start_webhook(path, request_handler=SecretWebhookRequestHandler, host=host, port=port)
 
 
 def main():
-    initiate_db()
+    global metrics_port
+    parser = argparse.ArgumentParser(description='Telegram-бот')
+    parser.add_argument('--webhook', metavar='URL', help='внешний адрес бота для режима webhook, без него - long polling')
+    parser.add_argument('--host', default=webhook_host, help='адрес сервера webhook')
+    parser.add_argument('--port', type=int, default=webhook_port, help='порт сервера webhook')
+    parser.add_argument('--path', default=webhook_path, help='путь webhook')
+    parser.add_argument('--api-server', metavar='URL', help='другой сервер Bot API, например fake_telegram.py')
+    parser.add_argument('--no-send-limits', action='store_true',
+                        help='не ограничивать скорость отправки, например для fake_telegram.py без --chat-rate')
+    parser.add_argument('--metrics-port', type=int, default=metrics_port,
+                        help=f'порт сервера метрик на {metrics_host}, 0 - без сервера')
+    parser.add_argument('--fsm-ttl', type=float, default=fsm_ttl,
+                        help='через сколько секунд без действий разговор удаляется')
+    parser.add_argument('--fsm-max-bytes', type=int, default=fsm_max_bytes,
+                        help='наибольший размер данных всех разговоров, байт')
+    args = parser.parse_args()
+    if args.webhook and not webhook_secret:
+        parser.exit(2, 'webhook mode requires webhook_secret in credentials.py, the same for every instance of the bot,\n'
+                       'for example: python -c "import secrets; print(secrets.token_urlsafe(32))"\n')
+
+    metrics_port = args.metrics_port
+    dp.storage.ttl = args.fsm_ttl
+    dp.storage.max_bytes = args.fsm_max_bytes
+    if args.api_server:
+        bot.server = TelegramAPIServer.from_base(args.api_server)
+    if args.no_send_limits:
+        send_scheduler.set_limits(None, 0, None, 0)
+
+    try:
+        initiate_db()
+    except crud_functions.MigrationError as e:
+        parser.exit(1, f'database migration failed: {e}\n')
     try:
-        global products
-        products = get_all_products()
-        executor.start_polling(dp, skip_updates=True)
+        # каталог загружается при первом запросе (refresh_catalog), а не до начала приёма обновлений
+        if args.webhook:
+            start_webhook(args.webhook, args.host, args.port, args.path)
+        else:
+            executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
     finally:
         close_db()
 
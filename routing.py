@@ -0,0 +1,192 @@
+#-----------------------------------------------------------------------------------------------------------------------
+# быстрый выбор обработчика сообщений и нажатий inline-кнопок
+#
+# aiogram проверяет фильтры всех обработчиков по порядку, пока не найдёт подходящий, поэтому обновление, попавшее
+# в последний обработчик (например, all_messages), проверяется всеми фильтрами всех обработчиков.
+#
+# RoutedHandler заранее разбирает простые фильтры каждого обработчика: состояние FSM (state=), точный текст (text=),
+# начало текста или данных кнопки (text_startswith=), команду (commands=) и тип сообщения (content_types=).
+# Для обновления он вычисляет ключ (состояние, текст, если он встречается в фильтрах, совпавшие начала, префикс
+# команды) и по словарю находит только те обработчики, которые могут подойти. Их фильтры проверяются как обычно,
+# в том же порядке, поэтому выбирается тот же обработчик, что и без RoutedHandler. Обработчики с другими фильтрами
+# (lambda, regexp, ignore_case, ...) никогда не отбрасываются. Обновления без текста проверяются всеми обработчиками.
+
+from aiogram import Dispatcher
+from aiogram.types import Message, CallbackQuery, ContentType
+from aiogram.dispatcher.handler import Handler, SkipHandler, CancelHandler, ctx_data, current_handler, _check_spec
+from aiogram.dispatcher.filters import check_filters, FilterNotPassed
+from aiogram.dispatcher.filters.builtin import StateFilter, Text, Command, ContentTypeFilter
+
+
+class Route:
+    """
+    то, что известно о фильтрах одного обработчика без их выполнения; None - ограничения нет
+    """
+    __slots__ = ('states', 'texts', 'prefixes', 'command_prefixes', 'text_content')
+
+    def __init__(self, handler_obj: Handler.HandlerObj):
+        self.states: frozenset | None = None
+        self.texts: frozenset | None = None
+        self.prefixes: tuple | None = None
+        self.command_prefixes: frozenset | None = None
+        self.text_content = True            # подходят ли сообщения с текстом
+        for filter_obj in handler_obj.filters or ():
+            f = filter_obj.filter
+            if isinstance(f, StateFilter) and '*' not in f.states:
+                self.states = frozenset(f.states)
+            elif isinstance(f, Text) and not f.ignore_case and all(isinstance(value, str) for value in
+                                                                   (f.equals or f.startswith or [None])):
+                if f.equals is not None:
+                    self.texts = frozenset(f.equals)
+                elif f.startswith is not None:
+                    self.prefixes = tuple(f.startswith)
+            elif isinstance(f, Command):
+                self.command_prefixes = frozenset(f.prefixes)
+            elif isinstance(f, ContentTypeFilter):
+                self.text_content = ContentType.ANY in f.content_types or ContentType.TEXT in f.content_types
+
+    def may_match(self, state, text: str) -> bool:
+        """
+        :return: False, если фильтры обработчика точно не пропустят обновление с этим состоянием и текстом
+        """
+        return (self.text_content
+                and (self.states is None or state in self.states)
+                and (self.texts is None or text in self.texts)
+                and (self.prefixes is None or text.startswith(self.prefixes))
+                and (self.command_prefixes is None or text[:1] in self.command_prefixes))
+
+
+class RoutedHandler(Handler):
+    """
+    Handler, который проверяет фильтры только тех обработчиков, что могут подойти обновлению
+    """
+    def __init__(self, dispatcher, once=True, middleware_key=None):
+        super().__init__(dispatcher, once, middleware_key)
+        self.routes: list[Route] = []
+        self.candidates: dict[tuple, list[Handler.HandlerObj]] = {}     # ключ обновления -> обработчики
+        self.texts: frozenset = frozenset()
+        self.prefix_lengths: tuple[int, ...] = ()
+        self.prefixes: frozenset = frozenset()
+        self.command_prefixes: frozenset = frozenset()
+
+    def register(self, handler, filters=None, index=None):
+        super().register(handler, filters, index)
+        self.rebuild()
+
+    def unregister(self, handler):
+        try:
+            return super().unregister(handler)
+        finally:
+            self.rebuild()
+
+    def rebuild(self):
+        """
+        разбирает фильтры заново; вызывается при каждом изменении списка обработчиков
+        """
+        self.routes = [Route(handler_obj) for handler_obj in self.handlers]
+        self.candidates = {}
+        self.texts = frozenset(text for route in self.routes if route.texts for text in route.texts)
+        self.prefixes = frozenset(prefix for route in self.routes if route.prefixes for prefix in route.prefixes)
+        self.prefix_lengths = tuple(sorted({len(prefix) for prefix in self.prefixes}))
+        self.command_prefixes = frozenset(prefix for route in self.routes if route.command_prefixes
+                                          for prefix in route.command_prefixes)
+
+    def key(self, state, text: str) -> tuple:
+        """
+        :return: ключ, одинаковый для всех текстов, которые фильтры обработчиков не различают
+        """
+        prefixes = frozenset(text[:length] for length in self.prefix_lengths if text[:length] in self.prefixes)
+        return (state, text if text in self.texts else None, prefixes,
+                text[:1] if text[:1] in self.command_prefixes else None)
+
+    async def route(self, obj) -> list[Handler.HandlerObj]:
+        """
+        :return: обработчики, фильтры которых нужно проверить, в порядке регистрации
+        """
+        if isinstance(obj, Message):
+            text, chat, user = obj.text, obj.chat, obj.from_user
+        elif isinstance(obj, CallbackQuery):
+            text, chat, user = obj.data, obj.message and obj.message.chat, obj.from_user
+        else:
+            return self.handlers
+        chat, user = chat and chat.id, user and user.id
+        if not text or not (chat or user):
+            return self.handlers
+
+        # состояние читается так же, как в StateFilter, и запоминается для него же: хранилище читается один раз
+        try:
+            state = StateFilter.ctx_state.get()
+        except LookupError:
+            state = await self.dispatcher.storage.get_state(chat=chat, user=user)
+            StateFilter.ctx_state.set(state)
+
+        key = self.key(state, text)
+        candidates = self.candidates.get(key)
+        if candidates is None:
+            # text - любой текст с этим ключом: для всех таких текстов may_match даёт одно и то же
+            candidates = self.candidates[key] = [handler_obj for handler_obj, route in zip(self.handlers, self.routes)
+                                                 if route.may_match(state, text)]
+        return candidates
+
+    async def notify(self, *args):
+        # тот же цикл, что и Handler.notify, но только по обработчикам из route
+        results = []
+
+        data = {}
+        ctx_data.set(data)
+
+        if self.middleware_key:
+            try:
+                await self.dispatcher.middleware.trigger(f"pre_process_{self.middleware_key}", args + (data,))
+            except CancelHandler:  # Allow to cancel current event
+                return results
+
+        try:
+            for handler_obj in await self.route(args[0]):
+                try:
+                    data.update(await check_filters(handler_obj.filters, args))
+                except FilterNotPassed:
+                    continue
+                else:
+                    ctx_token = current_handler.set(handler_obj.handler)
+                    try:
+                        if self.middleware_key:
+                            await self.dispatcher.middleware.trigger(f"process_{self.middleware_key}", args + (data,))
+                        partial_data = _check_spec(handler_obj.spec, data)
+                        response = await handler_obj.handler(*args, **partial_data)
+                        if response is not None:
+                            results.append(response)
+                        if self.once:
+                            break
+                    except SkipHandler:
+                        continue
+                    except CancelHandler:
+                        break
+                    finally:
+                        current_handler.reset(ctx_token)
+        finally:
+            if self.middleware_key:
+                await self.dispatcher.middleware.trigger(f"post_process_{self.middleware_key}",
+                                                         args + (results, data,))
+
+        return results
+
+
+def install(dp: Dispatcher):
+    """
+    заменяет обработчики сообщений и нажатий inline-кнопок диспетчера на RoutedHandler
+    Уже зарегистрированные обработчики сохраняются.
+    """
+    for name, key in (('message_handlers', 'message'), ('callback_query_handlers', 'callback_query')):
+        handler = getattr(dp, name)
+        routed = RoutedHandler(dp, handler.once, key)
+        routed.handlers = handler.handlers
+        routed.rebuild()
+        setattr(dp, name, routed)
+
+        # фильтры (commands=, text=, ...) привязаны к объектам Handler диспетчера - привязываем их к новому
+        for record in dp.filters_factory._registered:
+            for attribute in ('event_handlers', 'exclude_event_handlers'):
+                handlers = getattr(record, attribute)
+                if handlers and handler in handlers:
+                    setattr(record, attribute, [routed if item is handler else item for item in handlers])
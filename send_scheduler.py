@@ -0,0 +1,358 @@
+#-----------------------------------------------------------------------------------------------------------------------
+# планировщик отправки сообщений через Bot API
+#
+# Telegram ограничивает отправку: около 1 сообщения в секунду в один чат и около 30 в секунду на всех, при превышении
+# отвечает 429 с retry_after. Планировщик перехватывает все запросы бота (bot.request), и запросы, отправляющие
+# сообщения, проходят через него:
+#   - токены: отдельное ведро на каждый чат и одно общее, альбом расходует по токену на картинку;
+#   - порядок: сообщения одного чата уходят строго по очереди, следующее - после ответа на предыдущее;
+#   - приоритет: между чатами первым отправляется сообщение с более высоким приоритетом, так ответ на нажатие
+#     кнопки не ждёт, пока другим пользователям уходят альбомы каталога (см. bulk_sends);
+#   - объединение: несколько текстовых сообщений, ждущих отправки в один чат, уходят одним сообщением;
+#   - 429: чат приостанавливается на retry_after секунд, сообщение отправляется повторно.
+# Остальные запросы (answerCallbackQuery, getMe, ...) идут в Bot API без очереди.
+# Ответ в теле webhook-ответа Telegram тоже считает отправленным сообщением, но он уходит не через bot.request:
+# перед ним обработчик вызывает reserve, которая ждёт очереди чата и расходует токены так же, как отправка.
+
+import json
+import time
+import heapq
+import asyncio
+import logging
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+
+log = logging.getLogger('send_scheduler')
+
+# приоритеты: чем меньше, тем раньше
+INTERACTIVE = 0     # ответы пользователю
+BULK = 1            # массовая отправка: каталог
+
+send_priority = contextvars.ContextVar('send_priority', default=INTERACTIVE)
+
+# методы, отправляющие сообщения в чат
+limited_methods = frozenset((
+    'sendMessage', 'sendPhoto', 'sendMediaGroup', 'sendDocument', 'sendAudio', 'sendVideo', 'sendAnimation',
+    'sendVoice', 'sendVideoNote', 'sendSticker', 'sendLocation', 'sendVenue', 'sendContact', 'sendPoll',
+    'sendDice', 'sendInvoice', 'sendGame', 'forwardMessage', 'copyMessage',
+))
+
+max_text_length = 4096      # длина текста одного сообщения в Telegram
+
+
+@contextmanager
+def bulk_sends():
+    """
+    сообщения, отправленные внутри блока with, уступают очередь ответам в других чатах
+    """
+    token = send_priority.set(BULK)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+class TokenBucket:
+    """
+    ведро токенов: rate токенов в секунду, не больше burst про запас, rate=None - без ограничения
+    Отправка возможна, пока есть хотя бы один токен; стоимость больше одного уводит ведро в минус,
+    и следующая отправка ждёт, пока долг не восполнится.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float | None, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now: float) -> float:
+        """
+        :return: момент, когда появится токен
+        """
+        if self.rate is None:
+            return now
+        self._refill(now)
+        return now if self.tokens >= 1 else now + (1 - self.tokens) / self.rate
+
+    def take(self, now: float, cost: float = 1):
+        if self.rate is None:
+            return
+        self._refill(now)
+        self.tokens -= cost
+
+    def skip(self, now: float):
+        """
+        не начисляет токены за время до now
+        """
+        self.updated = max(self.updated, now)
+
+    def full(self, now: float) -> bool:
+        if self.rate is None:
+            return True
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+def message_cost(method: str, data: dict) -> int:
+    """
+    :return: число сообщений, которое отправит запрос
+    """
+    if method == 'sendMediaGroup':
+        media = data.get('media')
+        return max(1, len(json.loads(media) if isinstance(media, str) else media or ()))
+    return 1
+
+
+class Send:
+    """
+    запрос в очереди чата
+    """
+    __slots__ = ('method', 'data', 'files', 'kwargs', 'priority', 'seq', 'futures', 'retries')
+
+    def __init__(self, method: str, data: dict, files, kwargs: dict, priority: int, seq: int):
+        self.method = method
+        self.data = data
+        self.files = files
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.retries = 0
+
+    def merge(self, other: 'Send') -> bool:
+        """
+        добавляет текст other к этому сообщению, если оба - простые текстовые сообщения
+        :return: True, если other объединён с этим сообщением
+        """
+        if self.method != 'sendMessage' or other.method != 'sendMessage' or self.files or other.files:
+            return False
+        if 'reply_markup' in self.data:       # клавиатура должна остаться под своим сообщением
+            return False
+        rest = {key: value for key, value in self.data.items() if key != 'text'}
+        other_rest = {key: value for key, value in other.data.items() if key not in ('text', 'reply_markup')}
+        if rest != other_rest:
+            return False
+        text = f'{self.data["text"]}\n\n{other.data["text"]}'
+        if len(text) > max_text_length:
+            return False
+        self.data = {**other.data, 'text': text}
+        self.futures.extend(other.futures)
+        return True
+
+
+class ChatQueue:
+    __slots__ = ('sends', 'bucket', 'busy', 'paused_until')
+
+    def __init__(self, bucket: TokenBucket):
+        self.sends: deque[Send] = deque()
+        self.bucket = bucket
+        self.busy = False           # отправка этого чата ещё ждёт ответа Bot API
+        self.paused_until = 0.0     # после 429
+
+
+class SendScheduler:
+    """
+    очередь отправки сообщений с ограничением скорости по чатам и общим
+    """
+    def __init__(self, chat_rate: float | None = 1.0, chat_burst: float = 3, global_rate: float | None = 30.0,
+                 global_burst: float = 20, max_retries: int = 5, coalesce: bool = True):
+        """
+        :param chat_rate:       сообщений в секунду в один чат, None - без ограничения
+        :param chat_burst:      сколько сообщений в один чат можно отправить подряд без ожидания
+        :param global_rate:     сообщений в секунду во все чаты, None - без ограничения
+        :param global_burst:    сколько сообщений можно отправить подряд без ожидания; меньше, чем допускает
+                                Telegram, - запас на неравномерную задержку запросов в сети
+        :param max_retries:     сколько раз повторять сообщение после 429, потом RetryAfter достаётся обработчику
+        :param coalesce:        объединять ждущие отправки текстовые сообщения одного чата
+        """
+        self.set_limits(chat_rate, chat_burst, global_rate, global_burst)
+        self.max_retries = max_retries
+        self.coalesce = coalesce
+
+        self.chats: dict[int | str, ChatQueue] = {}
+        self.ready: list[tuple[int, int, int | str]] = []               # (приоритет, номер, чат)
+        self.waiting: list[tuple[float, int, int, int | str]] = []     # (когда, приоритет, номер, чат)
+        self.seq = 0
+        self.request = None                 # bot.request до install
+        self.wakeup: asyncio.Event | None = None
+        self.runner: asyncio.Task | None = None
+        self.stats = {'sent': 0, 'coalesced': 0, 'retries': 0, 'reserved': 0}
+
+    def set_limits(self, chat_rate: float | None, chat_burst: float, global_rate: float | None, global_burst: float):
+        """
+        меняет лимиты, лимит чата - для чатов, которых сейчас нет в очереди
+        """
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+
+    def install(self, bot: Bot):
+        """
+        направляет все запросы bot через планировщик
+        """
+        request = self.request = bot.request
+
+        async def scheduled_request(method: str, data=None, files=None, **kwargs):
+            if method not in limited_methods or not data or 'chat_id' not in data:
+                return await request(method, data, files, **kwargs)
+            return await self.submit(request, method, data, files, kwargs)
+
+        bot.request = scheduled_request
+
+    #-------------------------------------------------------------------------------------------------------------------
+    # очередь
+
+    async def submit(self, request, method: str, data: dict, files, kwargs: dict):
+        """
+        ставит запрос в очередь его чата и ждёт ответа Bot API
+        """
+        if self.runner is None or self.runner.done() or self.runner.get_loop() is not asyncio.get_running_loop():
+            self.wakeup = asyncio.Event()
+            self.runner = asyncio.create_task(self._run(request))
+            self.chats.clear()
+            self.ready.clear()
+            self.waiting.clear()
+
+        self.seq += 1
+        send = Send(method, data, files, kwargs, send_priority.get(), self.seq)
+        chat_id = data['chat_id']
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = ChatQueue(TokenBucket(self.chat_rate, self.chat_burst))
+        chat.sends.append(send)
+        if len(chat.sends) == 1 and not chat.busy:
+            self._schedule(chat_id, chat)
+        return await send.futures[0]
+
+    async def reserve(self, chat_id: int | str):
+        """
+        ждёт очереди чата и токенов для сообщения, которое уходит не через bot.request, - ответа в теле
+        webhook-ответа. Сообщения чата, поставленные в очередь раньше, отправляются до него.
+        """
+        if self.request is not None:
+            await self.submit(self.request, None, {'chat_id': chat_id}, None, {})
+
+    def _schedule(self, chat_id, chat: ChatQueue):
+        """
+        ставит первое сообщение чата в очередь готовых или ожидающих
+        """
+        head = chat.sends[0]
+        now = time.monotonic()
+        ready_at = max(chat.bucket.ready_at(now), chat.paused_until)
+        if ready_at <= now:
+            heapq.heappush(self.ready, (head.priority, head.seq, chat_id))
+        else:
+            heapq.heappush(self.waiting, (ready_at, head.priority, head.seq, chat_id))
+        self.wakeup.set()
+
+    async def _run(self, request):
+        while True:
+            now = time.monotonic()
+            while self.waiting and self.waiting[0][0] <= now:
+                _, priority, seq, chat_id = heapq.heappop(self.waiting)
+                heapq.heappush(self.ready, (priority, seq, chat_id))
+
+            timeout = self.waiting[0][0] - now if self.waiting else None
+            if self.ready:
+                global_at = self.global_bucket.ready_at(now)
+                if global_at <= now:
+                    _, _, chat_id = heapq.heappop(self.ready)
+                    self._start(request, chat_id, self.chats[chat_id], now)
+                    continue
+                timeout = global_at - now if timeout is None else min(timeout, global_at - now)
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start(self, request, chat_id, chat: ChatQueue, now: float):
+        send = chat.sends.popleft()
+        if self.coalesce:
+            while chat.sends and send.merge(chat.sends[0]):
+                chat.sends.popleft()
+                self.stats['coalesced'] += 1
+        cost = message_cost(send.method, send.data)
+        chat.bucket.take(now, cost)
+        self.global_bucket.take(now, cost)
+        chat.busy = True
+        asyncio.create_task(self._send(request, chat_id, chat, send))
+
+    async def _send(self, request, chat_id, chat: ChatQueue, send: Send):
+        try:
+            if send.method is None:         # reserve: токены уже взяты, запроса нет
+                self.stats['reserved'] += 1
+                self._finish(send)
+            else:
+                result = await request(send.method, send.data, send.files, **send.kwargs)
+                self.stats['sent'] += 1
+                self._finish(send, result=result)
+        except RetryAfter as e:
+            if send.retries < self.max_retries:
+                send.retries += 1
+                self.stats['retries'] += 1
+                log.warning('chat %s: retry after %s s', chat_id, e.timeout)
+                chat.paused_until = time.monotonic() + e.timeout
+                chat.sends.appendleft(send)
+            else:
+                self._finish(send, exception=e)
+        except Exception as e:
+            self._finish(send, exception=e)
+        except BaseException:
+            # отмена: ожидающие этого сообщения тоже отменяются, а очередь чата продолжает работать
+            for future in send.futures:
+                future.cancel()
+            raise
+        finally:
+            # Telegram считает сообщение отправленным, когда получил его, - для долгой загрузки альбома заметно позже,
+            # чем сообщение ушло: токены чата за время запроса не начисляются
+            chat.bucket.skip(time.monotonic())
+            chat.busy = False
+            if chat.sends:
+                self._schedule(chat_id, chat)
+            elif chat.bucket.full(time.monotonic()) and time.monotonic() >= chat.paused_until:
+                if self.chats.get(chat_id) is chat:
+                    del self.chats[chat_id]
+            else:
+                # ведро чата ещё не восполнилось - запоминаем его, пока оно нужно
+                self._forget_later(chat_id, chat)
+
+    def _forget_later(self, chat_id, chat: ChatQueue):
+        delay = max(chat.paused_until - time.monotonic(), 0)
+        if self.chat_rate:
+            delay += self.chat_burst / self.chat_rate
+
+        def forget():
+            if self.chats.get(chat_id) is not chat or chat.sends or chat.busy:
+                return
+            if chat.bucket.full(time.monotonic()):
+                del self.chats[chat_id]
+            else:
+                self._forget_later(chat_id, chat)
+        asyncio.get_running_loop().call_later(delay, forget)
+
+    @staticmethod
+    def _finish(send: Send, result=None, exception: Exception = None):
+        for future in send.futures:
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    async def close(self):
+        if self.runner is not None:
+            self.runner.cancel()
+            self.runner = None
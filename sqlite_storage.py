@@ -0,0 +1,373 @@
+#-----------------------------------------------------------------------------------------------------------------------
+# хранилище состояний FSM в SQLite
+#
+# В отличие от MemoryStorage:
+#   - состояния переживают перезапуск бота - они хранятся в отдельном файле базы данных в режиме WAL;
+#   - в памяти держится не больше cache_size последних разговоров (LRU), остальные читаются из базы по запросу;
+#   - разговоры, в которых ничего не происходило дольше ttl секунд, считаются брошенными и удаляются:
+#     при чтении сразу, из памяти и базы - раз в expire_interval секунд;
+#   - данные разговоров в памяти занимают не больше memory_budget байт: сверх него самые давние разговоры
+#     вытесняются из памяти (остаются в базе);
+#   - если задан max_bytes, данные всех разговоров в базе занимают не больше max_bytes байт: сверх него
+#     самые давние разговоры удаляются, как брошенные;
+#   - изменения пишутся в базу пачками: при batch_size изменённых разговоров или раз в flush_interval секунд.
+#     При падении процесса теряются изменения не старше flush_interval секунд;
+#   - stats и state_counts (метрики) просматривают всю таблицу, поэтому считаются не чаще раза в stats_interval
+#     секунд и через отдельное соединение в своём потоке: в режиме WAL просмотр не задерживает чтение и запись
+#     разговоров.
+#
+# Размер разговора - длина его состояния, data и bucket в JSON. Он пересчитывается при записи в базу, поэтому
+# бюджет памяти может быть превышен на изменения последних flush_interval секунд.
+
+import copy
+import json
+import time
+import typing
+import asyncio
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from aiogram.dispatcher.storage import BaseStorage
+
+
+fsm_table = 'FSM'
+
+Address = tuple[str, str]       # (chat, user)
+
+
+# размер разговора в базе, тот же, что record['size']
+size_sql = 'length(data) + length(bucket) + ifnull(length(state), 0)'
+
+
+def empty_record() -> dict:
+    return {'state': None, 'data': {}, 'bucket': {}, 'updated': time.time(), 'size': 4}
+
+
+def is_empty(record: dict) -> bool:
+    return record['state'] is None and not record['data'] and not record['bucket']
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    хранилище состояний FSM в SQLite с ограниченным кэшем в памяти
+    """
+    def __init__(self, filename: str = 'fsm.db', cache_size: int = 10_000, ttl: float = 24 * 60 * 60,
+                 batch_size: int = 100, flush_interval: float = 1.0, memory_budget: int = 16 * 2**20,
+                 max_bytes: int | None = None, expire_interval: float = 60.0, stats_interval: float = 60.0):
+        """
+        :param filename:        файл базы данных, открывается при первом обращении
+        :param cache_size:      сколько разговоров держать в памяти
+        :param ttl:             через сколько секунд бездействия разговор удаляется, None - никогда
+        :param batch_size:      сколько изменённых разговоров записывать одной транзакцией
+        :param flush_interval:  как часто записывать изменения, с
+        :param memory_budget:   сколько байт данных разговоров держать в памяти
+        :param max_bytes:       сколько байт данных разговоров хранить в базе, None - без ограничения
+        :param expire_interval: как часто удалять брошенные разговоры, с
+        :param stats_interval:  как часто пересчитывать stats и state_counts, с
+        """
+        self.filename = filename
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.memory_budget = memory_budget
+        self.max_bytes = max_bytes
+        self.expire_interval = expire_interval
+        self.stats_interval = stats_interval
+
+        self.cache: OrderedDict[Address, dict] = OrderedDict()
+        self.cache_bytes = 0                        # сумма размеров разговоров в self.cache
+        self.dirty: dict[Address, dict] = {}        # изменённые, но ещё не записанные разговоры
+        self.db: sqlite3.Connection | None = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fsm')
+        self.flusher: asyncio.Task | None = None
+
+        self.stats_db: sqlite3.Connection | None = None
+        self.stats_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fsm_stats')
+        self.stats_lock = asyncio.Lock()
+        self.usage: dict[str | None, tuple[int, int]] = {}     # состояние -> (число разговоров, размер)
+        self.usage_time = -float('inf')                         # когда посчитан self.usage, time.monotonic()
+
+    #-------------------------------------------------------------------------------------------------------------------
+    # база данных, все функции выполняются в потоке self.executor
+
+    def _connect(self):
+        if self.db is not None:
+            return
+        self.db = sqlite3.connect(self.filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute('PRAGMA busy_timeout = 5000')     # общий файл с другими процессами бота
+        self.db.execute(f'CREATE TABLE IF NOT EXISTS {fsm_table} ('
+                        'chat TEXT NOT NULL, user TEXT NOT NULL, state TEXT, data TEXT NOT NULL, '
+                        'bucket TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (chat, user)) WITHOUT ROWID')
+        self.db.execute(f'CREATE INDEX IF NOT EXISTS {fsm_table}_updated ON {fsm_table} (updated)')
+
+    def _load(self, address: Address) -> dict | None:
+        self._connect()
+        row = self.db.execute(f'SELECT state, data, bucket, updated FROM {fsm_table} WHERE chat = ? AND user = ?',
+                              address).fetchone()
+        if row is None:
+            return None
+        state, data, bucket, updated = row
+        return {'state': state, 'data': json.loads(data), 'bucket': json.loads(bucket), 'updated': updated,
+                'size': len(state or '') + len(data) + len(bucket)}
+
+    def _save(self, deleted: list[Address], rows: list[tuple]):
+        self._connect()
+        with self.db:
+            self.db.executemany(f'DELETE FROM {fsm_table} WHERE chat = ? AND user = ?', deleted)
+            self.db.executemany(f'INSERT OR REPLACE INTO {fsm_table} VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def _delete_expired(self, before: float):
+        self._connect()
+        with self.db:
+            self.db.execute(f'DELETE FROM {fsm_table} WHERE updated < ?', (before,))
+
+    def _delete_oldest(self, max_bytes: int) -> list[Address]:
+        """
+        удаляет самые давние разговоры, пока данные остальных не уложатся в max_bytes
+        :return: удалённые разговоры
+        """
+        self._connect()
+        with self.db:
+            total = self.db.execute(f'SELECT ifnull(SUM({size_sql}), 0) FROM {fsm_table}').fetchone()[0]
+            if total <= max_bytes:
+                return []
+            # разговоры от самого давнего, пока их суммарный размер не покроет превышение
+            oldest = self.db.execute(f'SELECT chat, user FROM (SELECT chat, user, {size_sql} AS size, '
+                                     f'SUM({size_sql}) OVER (ORDER BY updated, chat, user) AS freed FROM {fsm_table}) '
+                                     'WHERE freed - size < ?', (total - max_bytes,)).fetchall()
+            self.db.executemany(f'DELETE FROM {fsm_table} WHERE chat = ? AND user = ?', oldest)
+        return oldest
+
+    def _usage(self, after: float) -> dict[str | None, tuple[int, int]]:
+        """
+        выполняется в потоке self.stats_executor
+        :return: {состояние: (число разговоров, их размер)} для разговоров, изменённых не раньше after
+        """
+        if self.stats_db is None:
+            self.stats_db = sqlite3.connect(self.filename, check_same_thread=False)
+            self.stats_db.execute('PRAGMA busy_timeout = 5000')
+            self.stats_db.execute('PRAGMA query_only = ON')
+        return {state: (count, size) for state, count, size in
+                self.stats_db.execute(f'SELECT state, COUNT(*), SUM({size_sql}) FROM {fsm_table} '
+                                      'WHERE updated >= ? GROUP BY state', (after,))}
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    #-------------------------------------------------------------------------------------------------------------------
+    # кэш
+
+    def _expired(self, record: dict) -> bool:
+        return self.ttl is not None and time.time() - record['updated'] > self.ttl
+
+    def _cache_put(self, address: Address, record: dict):
+        old = self.cache.get(address)
+        if old is not None:
+            self.cache_bytes -= old['size']
+        self.cache[address] = record
+        self.cache.move_to_end(address)
+        self.cache_bytes += record['size']
+        # самые давние разговоры - в начале; текущий не вытесняется, даже если он один больше бюджета
+        while len(self.cache) > 1 and (len(self.cache) > self.cache_size or self.cache_bytes > self.memory_budget):
+            _, evicted = self.cache.popitem(last=False)     # несохранённые изменения остаются в self.dirty
+            self.cache_bytes -= evicted['size']
+
+    def _cache_pop(self, address: Address):
+        record = self.cache.pop(address, None)
+        if record is not None:
+            self.cache_bytes -= record['size']
+
+    async def _get(self, chat, user) -> tuple[Address, dict]:
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        address = (chat, user)
+        self._start()
+
+        record = self.cache.get(address) or self.dirty.get(address)
+        if record is None:
+            loaded = await self._run(self._load, address)
+            # пока читали, разговор мог появиться в кэше
+            record = self.cache.get(address) or self.dirty.get(address) or loaded or empty_record()
+        if self._expired(record):
+            record = empty_record()
+
+        self._cache_put(address, record)
+        return address, record
+
+    async def _changed(self, address: Address, record: dict):
+        record['updated'] = time.time()
+        self.dirty[address] = record
+        if is_empty(record):
+            self._cache_pop(address)
+
+        self._start()
+        if len(self.dirty) >= self.batch_size:
+            await self.flush()
+
+    def _start(self):
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self._flush_periodically())
+
+    async def flush(self):
+        """
+        записывает изменённые разговоры в базу данных
+        """
+        if not self.dirty:
+            return
+        records, self.dirty = self.dirty, {}
+        deleted, rows = [], []
+        for address, record in records.items():
+            if is_empty(record):
+                deleted.append(address)
+                continue
+            # JSON - здесь, а не в потоке базы данных: обработчики могут менять record, пока идёт запись
+            data, bucket = json.dumps(record['data']), json.dumps(record['bucket'])
+            size = len(record['state'] or '') + len(data) + len(bucket)   # json.dumps пишет только ASCII
+            if self.cache.get(address) is record:
+                self.cache_bytes += size - record['size']
+            record['size'] = size
+            rows.append((*address, record['state'], data, bucket, record['updated']))
+        await self._run(self._save, deleted, rows)
+
+    async def expire(self):
+        """
+        удаляет разговоры, в которых ничего не происходило дольше ttl секунд, и самые давние разговоры сверх max_bytes
+        """
+        if self.ttl is not None:
+            before = time.time() - self.ttl
+            for address in [address for address, record in self.cache.items() if record['updated'] < before]:
+                self._cache_pop(address)
+            for address in [address for address, record in self.dirty.items() if record['updated'] < before]:
+                del self.dirty[address]
+            await self._run(self._delete_expired, before)
+
+        if self.max_bytes is not None:
+            await self.flush()
+            for address in await self._run(self._delete_oldest, self.max_bytes):
+                if address not in self.dirty:       # изменён, пока удаляли, - уже не самый давний
+                    self._cache_pop(address)
+
+    async def _get_usage(self) -> dict[str | None, tuple[int, int]]:
+        """
+        :return: self.usage, пересчитанный, если он старше stats_interval секунд
+        """
+        async with self.stats_lock:     # одновременные запросы метрик ждут один пересчёт
+            if time.monotonic() - self.usage_time >= self.stats_interval:
+                await self.flush()
+                if self.db is None:
+                    await self._run(self._connect)      # таблица создаётся при подключении
+                after = time.time() - self.ttl if self.ttl is not None else 0.0
+                self.usage = await asyncio.get_running_loop().run_in_executor(self.stats_executor, self._usage,
+                                                                              after)
+                self.usage_time = time.monotonic()
+        return self.usage
+
+    async def stats(self) -> dict[str, int]:
+        """
+        :return: число живых разговоров и размер их данных, всего (не старше stats_interval секунд) и в памяти
+        """
+        usage = await self._get_usage()
+        return {'conversations': sum(count for count, _ in usage.values()),
+                'bytes': sum(size for _, size in usage.values()),
+                'cached_conversations': len(self.cache), 'cached_bytes': self.cache_bytes}
+
+    async def state_counts(self) -> dict[str, int]:
+        """
+        :return: {состояние: число разговоров в нём}, без брошенных разговоров, не старше stats_interval секунд
+        """
+        return {state: count for state, (count, _) in (await self._get_usage()).items() if state is not None}
+
+    async def _flush_periodically(self):
+        last_expire = time.monotonic()
+        while True:
+            await asyncio.sleep(min(self.flush_interval, self.expire_interval))
+            await self.flush()
+            if time.monotonic() - last_expire >= self.expire_interval:
+                await self.expire()
+                last_expire = time.monotonic()
+
+    #-------------------------------------------------------------------------------------------------------------------
+    # BaseStorage
+
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        await self.flush()
+        self.cache.clear()
+        self.cache_bytes = 0
+
+    async def wait_closed(self):
+        if self.db is not None:
+            await self._run(self.db.close)
+            self.db = None
+        if self.stats_db is not None:
+            await asyncio.get_running_loop().run_in_executor(self.stats_executor, self.stats_db.close)
+            self.stats_db = None
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, record = await self._get(chat, user)
+        return record['state'] if record['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[str] = None) -> typing.Dict:
+        _, record = await self._get(chat, user)
+        return copy.deepcopy(record['data'])
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        address, record = await self._get(chat, user)
+        record['state'] = self.resolve_state(state)
+        await self._changed(address, record)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        address, record = await self._get(chat, user)
+        record['data'] = copy.deepcopy(data) if data else {}
+        await self._changed(address, record)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        address, record = await self._get(chat, user)
+        record['data'].update(data or {}, **kwargs)
+        await self._changed(address, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._get(chat, user)
+        return copy.deepcopy(record['bucket'])
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        address, record = await self._get(chat, user)
+        record['bucket'] = copy.deepcopy(bucket) if bucket else {}
+        await self._changed(address, record)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        address, record = await self._get(chat, user)
+        record['bucket'].update(bucket or {}, **kwargs)
+        await self._changed(address, record)
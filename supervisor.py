@@ -0,0 +1,243 @@
+"""
+несколько процессов бота: обновления распределяются между процессами по chat_id
+
+Все обновления одного чата попадают в один и тот же процесс и обрабатываются в нём по порядку, поэтому состояние FSM
+чата никогда не меняют два процесса одновременно. Общие database.db и fsm.db работают в режиме WAL.
+
+Запуск:
+    python supervisor.py --workers 4 [--api-server http://localhost:8081]
+"""
+import queue
+import signal
+import asyncio
+import logging
+import argparse
+import threading
+import contextvars
+import multiprocessing
+
+from aiogram import Bot, Dispatcher
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.types import Update
+
+import crud_functions
+
+
+log = logging.getLogger('supervisor')
+
+
+def update_chat_id(update: dict) -> int:
+    """
+    :param update:  обновление Telegram в виде словаря
+    :return:        чат, к которому относится обновление, или пользователь, если чата нет
+    """
+    for kind in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if kind in update:
+            return update[kind]['chat']['id']
+    callback_query = update.get('callback_query')
+    if callback_query is not None and 'message' in callback_query:
+        return callback_query['message']['chat']['id']
+    for value in update.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return 0
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# рабочий процесс
+
+def worker_main(index: int, updates: multiprocessing.Queue, events: multiprocessing.Queue, api_server: str | None,
+                workers: int = 1, send_limits: bool = True):
+    """
+    точка входа рабочего процесса
+    :param index:       номер процесса
+    :param updates:     очередь обновлений этого процесса, None - остановиться
+    :param events:      очередь для сообщений супервизору: ('ready', index), ('done', index, processed)
+    :param api_server:  другой сервер Bot API
+    :param workers:     число рабочих процессов: общий лимит отправки Telegram делится между ними
+    :param send_limits: ограничивать скорость отправки сообщений
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)     # останавливает супервизор через stop()
+    import module_14_5 as bot_module
+    asyncio.run(run_worker(bot_module, index, updates, events, api_server, workers, send_limits))
+
+
+async def run_worker(bot_module, index: int, updates: multiprocessing.Queue, events: multiprocessing.Queue,
+                     api_server: str | None, workers: int = 1, send_limits: bool = True):
+    from crud_functions import initiate_db, close_db
+    from async_crud_functions import flush_writes_periodically
+
+    if api_server:
+        bot_module.bot.server = TelegramAPIServer.from_base(api_server)
+    scheduler = bot_module.send_scheduler
+    if not send_limits:
+        scheduler.set_limits(None, 0, None, 0)
+    elif scheduler.global_bucket.rate:
+        # каждый чат - только в одном процессе, а общий лимит - на всех
+        scheduler.set_limits(scheduler.chat_rate, scheduler.chat_burst,
+                             scheduler.global_bucket.rate / workers, scheduler.global_bucket.burst / workers)
+    initiate_db()          # схема уже актуальна (Supervisor.start), каталог загружается при первом запросе
+    Bot.set_current(bot_module.bot)
+    Dispatcher.set_current(bot_module.dp)
+    flusher = asyncio.create_task(flush_writes_periodically())
+
+    context = contextvars.copy_context()     # текущие Bot и Dispatcher для обработчиков
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+    tails: dict[int, asyncio.Task] = {}     # последнее обновление каждого чата, которое ещё обрабатывается
+    processed = 0
+
+    async def process(update: dict, previous: asyncio.Task | None):
+        nonlocal processed
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            # как при long polling: через updates_handler, с middleware уровня обновлений
+            await bot_module.dp.updates_handler.notify(Update(**update))
+        except Exception:
+            log.exception('worker %d: update %s failed', index, update.get('update_id'))
+        processed += 1
+
+    def dispatch(update: dict):
+        chat_id = update_chat_id(update)
+        task = loop.create_task(process(update, tails.get(chat_id)))
+        tails[chat_id] = task
+
+        def forget(done: asyncio.Task):
+            if tails.get(chat_id) is done:
+                del tails[chat_id]
+        task.add_done_callback(forget)
+
+    def receive():
+        # очередь multiprocessing блокирующая - читаем её в отдельном потоке
+        while True:
+            update = updates.get()
+            if update is None:
+                loop.call_soon_threadsafe(stopped.set_result, None)
+                return
+            loop.call_soon_threadsafe(dispatch, update, context=context)
+
+    threading.Thread(target=receive, daemon=True).start()
+    events.put(('ready', index))
+
+    await stopped
+    while tails:
+        await asyncio.wait(list(tails.values()))
+
+    flusher.cancel()
+    await bot_module.dp.storage.close()
+    await bot_module.dp.storage.wait_closed()
+    await (await bot_module.bot.get_session()).close()
+    close_db()
+    events.put(('done', index, processed))
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# супервизор
+
+class Supervisor:
+    """
+    запускает рабочие процессы и распределяет между ними обновления по chat_id
+    """
+    def __init__(self, workers: int, api_server: str = None, send_limits: bool = True):
+        """
+        :param workers:     число рабочих процессов
+        :param api_server:  другой сервер Bot API для рабочих процессов
+        :param send_limits: ограничивать скорость отправки сообщений
+        """
+        context = multiprocessing.get_context('spawn')
+        self.queues = [context.Queue() for _ in range(workers)]
+        self.events = context.Queue()
+        self.processes = [context.Process(target=worker_main, name=f'bot-worker-{index}',
+                                          args=(index, queue, self.events, api_server, workers, send_limits))
+                          for index, queue in enumerate(self.queues)]
+
+    def start(self):
+        """
+        запускает рабочие процессы и ждёт, пока все они будут готовы принимать обновления
+        """
+        # миграции схемы выполняются один раз здесь, до запуска рабочих процессов, а не в каждом из них одновременно
+        crud_functions.initiate_db()
+        crud_functions.close_db()
+        for process in self.processes:
+            process.start()
+        ready = 0
+        while ready < len(self.processes):
+            try:
+                self.events.get(timeout=1)
+                ready += 1
+            except queue.Empty:
+                failed = [process.name for process in self.processes if process.exitcode is not None]
+                if failed:
+                    self.terminate()
+                    raise RuntimeError(f'worker processes exited on startup: {", ".join(failed)}')
+
+    def route(self, update: dict):
+        """
+        :param update:  обновление Telegram в виде словаря
+        """
+        self.queues[hash(update_chat_id(update)) % len(self.queues)].put(update)
+
+    def stop(self) -> dict[int, int]:
+        """
+        останавливает рабочие процессы, дождавшись обработки всех уже отправленных им обновлений
+        :return: {номер процесса: число обработанных обновлений}
+        """
+        for queue in self.queues:
+            queue.put(None)
+        processed = {}
+        for _ in self.processes:
+            _, index, count = self.events.get()
+            processed[index] = count
+        for process in self.processes:
+            process.join()
+        return processed
+
+    def terminate(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+async def poll_updates(bot: Bot, supervisor: Supervisor):
+    """
+    получает обновления long polling'ом и отправляет их рабочим процессам
+    """
+    await bot.delete_webhook(drop_pending_updates=True)
+    offset = None
+    while True:
+        updates = await bot.get_updates(offset=offset, timeout=20)
+        for update in updates:
+            supervisor.route(update.to_python())
+            offset = update.update_id + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='число рабочих процессов')
+    parser.add_argument('--api-server', metavar='URL', help='другой сервер Bot API, например fake_telegram.py')
+    parser.add_argument('--no-send-limits', action='store_true',
+                        help='не ограничивать скорость отправки, например для fake_telegram.py без --chat-rate')
+    args = parser.parse_args()
+
+    from credentials import token
+    bot = Bot(token=token)
+    if args.api_server:
+        bot.server = TelegramAPIServer.from_base(args.api_server)
+
+    supervisor = Supervisor(args.workers, args.api_server, not args.no_send_limits)
+    try:
+        supervisor.start()
+    except crud_functions.MigrationError as e:
+        parser.exit(1, f'database migration failed: {e}\n')
+    try:
+        asyncio.run(poll_updates(bot, supervisor))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        supervisor.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+выгрузка и загрузка таблиц Users и Products в CSV, JSON Lines и Parquet
+
+Записи читаются и пишутся по мере перебора, поэтому память не зависит от размера таблицы. Загрузка - одна
+транзакция через executemany. Для Parquet нужен pyarrow.
+
+Формат определяется по расширению файла: .csv, .jsonl, .parquet
+
+Запуск:
+    python table_io.py export Users users.csv
+    python table_io.py import Products products.jsonl [--skip-duplicates]
+"""
+import os
+import csv
+import json
+import sqlite3
+import argparse
+from itertools import islice, chain
+from typing import Iterable, Iterator
+
+import crud_functions
+from crud_functions import db_int, db_id, db_int_not_null
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+formats = ('csv', 'jsonl', 'parquet')
+chunk_size = 10_000         # записей в одной части: fetchmany, группа строк Parquet
+
+# столбцы INTEGER, в которых бывают и дробные числа: бот записывает возраст как float(message.text)
+float_columns = {(crud_functions.users_table, 'age')}
+
+
+def file_format(filename: str) -> str:
+    extension = os.path.splitext(filename)[1].lstrip('.').lower()
+    if extension not in formats:
+        raise ValueError(f'unknown format of {filename}, expected one of: {", ".join(formats)}')
+    if extension == 'parquet' and pyarrow is None:
+        raise RuntimeError('Parquet requires pyarrow: pip install pyarrow')
+    return extension
+
+
+def chunks(records: Iterable[tuple], size: int = chunk_size) -> Iterator[list[tuple]]:
+    records = iter(records)
+    while chunk := list(islice(records, size)):
+        yield chunk
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# запись
+
+def write_csv(filename: str, key_names: list[str], records: Iterable[tuple]):
+    # NULL записывается пустой строкой и при загрузке становится пустой строкой
+    with open(filename, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(key_names)
+        writer.writerows(records)
+
+
+def write_jsonl(filename: str, key_names: list[str], records: Iterable[tuple]):
+    with open(filename, 'w', encoding='utf-8') as file:
+        for record in records:
+            file.write(json.dumps(dict(zip(key_names, record)), ensure_ascii=False))
+            file.write('\n')
+
+
+def parquet_type(table: str, key_name: str, key_type: str):
+    if (table, key_name) in float_columns:
+        return pyarrow.float64()
+    return pyarrow.int64() if key_type in (db_id, db_int, db_int_not_null) else pyarrow.string()
+
+
+def parquet_schema(table: str, key_names: list[str]):
+    types = dict(crud_functions.table_keys[table])
+    return pyarrow.schema([(key_name, parquet_type(table, key_name, types[key_name])) for key_name in key_names])
+
+
+def write_parquet(filename: str, key_names: list[str], records: Iterable[tuple], schema):
+    with pyarrow.parquet.ParquetWriter(filename, schema) as writer:
+        for chunk in chunks(records):
+            # pyarrow.array(values, type=int64) молча отбрасывает дробную часть, а cast - ошибка ArrowInvalid
+            columns = [pyarrow.array(list(column)).cast(field.type) for column, field in zip(zip(*chunk), schema)]
+            writer.write_batch(pyarrow.record_batch(columns, schema=schema))
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+# чтение
+
+def read_csv(filename: str) -> tuple[list[str], Iterator[tuple]]:
+    file = open(filename, newline='', encoding='utf-8')
+    reader = csv.reader(file)
+    key_names = next(reader, None)
+    if not key_names:
+        file.close()
+        return [], iter(())
+
+    def records():
+        with file:
+            yield from map(tuple, reader)
+    return key_names, records()
+
+
+def read_jsonl(filename: str) -> tuple[list[str], Iterator[tuple]]:
+    file = open(filename, encoding='utf-8')
+    first = file.readline()
+    if not first.strip():
+        file.close()
+        return [], iter(())
+    key_names = list(json.loads(first))
+
+    def records():
+        with file:
+            for line in chain([first], file):
+                if line.strip():
+                    record = json.loads(line)
+                    yield tuple(record[key_name] for key_name in key_names)
+    return key_names, records()
+
+
+def read_parquet(filename: str) -> tuple[list[str], Iterator[tuple]]:
+    parquet = pyarrow.parquet.ParquetFile(filename)
+    key_names = parquet.schema_arrow.names
+
+    def records():
+        for batch in parquet.iter_batches(batch_size=chunk_size):
+            yield from zip(*[column.to_pylist() for column in batch.columns])
+    return key_names, records()
+
+
+def csv_nulls(table: str, key_names: list[str], records: Iterable[tuple]) -> Iterator[tuple]:
+    """
+    пустые значения числовых столбцов из CSV - NULL: иначе пустые строки нарушили бы уникальность telegram_id
+    """
+    types = dict(crud_functions.table_keys[table])
+    integer = [types.get(key_name) in (db_id, db_int, db_int_not_null) for key_name in key_names]
+    for record in records:
+        yield tuple(None if is_integer and value == '' else value for is_integer, value in zip(integer, record))
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+def export_table(table: str, filename: str) -> int:
+    """
+    выгружает таблицу в файл
+    :return: число выгруженных записей
+    """
+    extension = file_format(filename)
+    key_names, records = crud_functions.export_records(table, chunk_size)
+
+    count = 0
+
+    def counted(records):
+        nonlocal count
+        for count, record in enumerate(records, 1):
+            yield record
+
+    if extension == 'csv':
+        write_csv(filename, key_names, counted(records))
+    elif extension == 'jsonl':
+        write_jsonl(filename, key_names, counted(records))
+    else:
+        write_parquet(filename, key_names, counted(records), parquet_schema(table, key_names))
+    return count
+
+
+def import_table(table: str, filename: str, skip_duplicates: bool = False) -> int:
+    """
+    загружает записи из файла в таблицу
+    :param skip_duplicates: пропускать записи, нарушающие уникальность (id, username, email), иначе - ошибка
+                            и таблица остаётся без изменений
+    :return:                число добавленных записей
+    """
+    extension = file_format(filename)
+    key_names, records = {'csv': read_csv, 'jsonl': read_jsonl, 'parquet': read_parquet}[extension](filename)
+    if not key_names:
+        return 0
+    if extension == 'csv':
+        records = csv_nulls(table, key_names, records)
+    return crud_functions.import_records(table, key_names, records, 'OR IGNORE' if skip_duplicates else '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default=crud_functions.database_filename, help='файл базы данных')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    for command in ('export', 'import'):
+        subparser = commands.add_parser(command, help='выгрузить таблицу' if command == 'export' else 'загрузить')
+        subparser.add_argument('table', choices=list(crud_functions.table_keys))
+        subparser.add_argument('file', help='файл .csv, .jsonl или .parquet')
+        if command == 'import':
+            subparser.add_argument('--skip-duplicates', action='store_true',
+                                   help='пропускать записи с занятыми id, username или email')
+    args = parser.parse_args()
+
+    crud_functions.database_filename = args.database
+    crud_functions.initiate_db()
+    try:
+        if args.command == 'export':
+            print(f'{export_table(args.table, args.file)} records exported')
+        else:
+            print(f'{import_table(args.table, args.file, args.skip_duplicates)} records imported')
+    except sqlite3.IntegrityError as e:
+        parser.exit(1, f'nothing imported: {e}, use --skip-duplicates to skip such records\n')
+    finally:
+        crud_functions.close_db()
+
+
+if __name__ == '__main__':
+    main()